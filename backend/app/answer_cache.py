@@ -0,0 +1,222 @@
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional, Tuple
+import asyncio
+import logging
+
+from app.config import get_settings
+from app.metrics import metrics
+from app.rag.singleflight import coalescer, normalize_question
+
+logger = logging.getLogger(__name__)
+
+
+class AnswerCache:
+    """
+    Cache persistente (colección `answer_cache`) de respuestas a las preguntas más frecuentes.
+
+    Las preguntas se minan de los chats de los últimos días y se precalculan en segundo plano
+    con prioridad baja: cada una espera a que no haya consultas de usuarios en curso.
+    La clave incluye la versión del índice, así un rebuild o una ingesta invalidan todo
+    sin borrar nada; las entradas viejas las elimina el índice TTL. Tras una ingesta el
+    cache se vuelve a calcular, a lo sumo una vez cada ANSWER_CACHE_INGEST_DELAY segundos.
+    """
+
+    def __init__(self):
+        self.db = None
+        self._warm_task: Optional[asyncio.Task] = None
+        self._loop_task: Optional[asyncio.Task] = None
+        self._ingest_task: Optional[asyncio.Task] = None
+        self._hit_tasks: set = set()
+        self.status: Dict[str, Any] = {"running": False}
+
+    async def attach(self, db, enabled: bool, ttl_days: int):
+        if not enabled:
+            return
+        await db.answer_cache.create_index("created_at", expireAfterSeconds=int(ttl_days * 86400))
+        await db.answer_cache.create_index("index_version")
+        self.db = db
+
+    @staticmethod
+    def _key(question: str, index_version: str) -> str:
+        return f"{index_version}:{normalize_question(question)}"
+
+    async def lookup(self, question: str) -> Optional[Dict[str, Any]]:
+        """Respuesta cacheada para la versión actual del índice, o None."""
+        from app.main import app_state
+
+        version = app_state.get('index_version')
+        if self.db is None or version is None:
+            return None
+        key = self._key(question, version)
+        try:
+            # Lectura simple por _id: el contador de hits se actualiza fuera del camino del request
+            doc = await self.db.answer_cache.find_one({"_id": key}, {"result": 1})
+        except Exception as e:
+            logger.warning(f"No se pudo consultar el cache de respuestas: {e}")
+            return None
+        if doc is None:
+            metrics.incr("answer_cache_misses")
+            return None
+        metrics.incr("answer_cache_hits")
+        task = asyncio.create_task(self._count_hit(key))
+        self._hit_tasks.add(task)
+        task.add_done_callback(self._hit_tasks.discard)
+        return doc["result"]
+
+    async def _count_hit(self, key: str):
+        try:
+            await self.db.answer_cache.update_one({"_id": key}, {"$inc": {"hits": 1}})
+        except Exception as e:
+            logger.debug(f"No se pudo contar el hit de {key}: {e}")
+
+    async def _exists(self, question: str, version: str) -> bool:
+        return await self.db.answer_cache.count_documents({"_id": self._key(question, version)}, limit=1) > 0
+
+    async def _put(self, question: str, version: str, count: int, result: Dict[str, Any]):
+        await self.db.answer_cache.replace_one(
+            {"_id": self._key(question, version)},
+            {
+                "question": question,
+                "index_version": version,
+                "asked": count,
+                "result": {k: result.get(k) for k in ("answer", "sources", "standalone_question", "model")},
+                "created_at": datetime.utcnow(),
+                "hits": 0,
+            },
+            upsert=True
+        )
+
+    async def mine(self, days: int, top_n: int, min_count: int) -> List[Tuple[str, int]]:
+        """
+        Preguntas más frecuentes de los últimos `days` días. Mongo agrupa por texto en minúsculas;
+        el agrupado final usa la misma normalización que el coalescing (tildes, puntuación).
+        """
+        since = datetime.utcnow() - timedelta(days=days)
+        pipeline = [
+            {"$match": {"updated_at": {"$gte": since}}},
+            {"$unwind": "$messages"},
+            {"$match": {"messages.role": "user", "messages.ts": {"$gte": since}}},
+            {"$group": {
+                "_id": {"$toLower": {"$trim": {"input": "$messages.content"}}},
+                "count": {"$sum": 1},
+                "question": {"$first": "$messages.content"},
+            }},
+            {"$sort": {"count": -1}},
+            {"$limit": top_n * 5},
+        ]
+        counts: Dict[str, List[Any]] = {}
+        async for row in self.db.chats.aggregate(pipeline, allowDiskUse=True):
+            entry = counts.setdefault(normalize_question(row["question"]), [row["question"], 0])
+            entry[1] += row["count"]
+        ranked = sorted(counts.values(), key=lambda entry: entry[1], reverse=True)
+        return [(question, count) for question, count in ranked if count >= min_count][:top_n]
+
+    async def _wait_idle(self):
+        # Prioridad baja: solo se calcula cuando no hay consultas de usuarios en curso
+        while coalescer.active > 0:
+            await asyncio.sleep(1.0)
+
+    async def _warm(self, reason: str):
+        from app.main import app_state
+        from app.api.chat import start_question_flight
+
+        settings = get_settings()
+        self.status = {
+            "running": True, "reason": reason, "started_at": datetime.utcnow(),
+            "mined": 0, "computed": 0, "cached": 0, "errors": 0,
+        }
+        logger.info(f"Precalculando respuestas frecuentes ({reason})...")
+        try:
+            questions = await self.mine(
+                settings.answer_cache_days,
+                settings.answer_cache_top_n,
+                settings.answer_cache_min_count
+            )
+            self.status["mined"] = len(questions)
+            for question, count in questions:
+                version = app_state.get('index_version')
+                if not app_state.get('chain') or version is None:
+                    break
+                if await self._exists(question, version):
+                    self.status["cached"] += 1
+                    continue
+                await self._wait_idle()
+                flight = start_question_flight(question)
+                try:
+                    result = await flight.result()
+                except Exception as e:
+                    self.status["errors"] += 1
+                    logger.warning(f"No se pudo precalcular '{question[:60]}': {e}")
+                    continue
+                finally:
+                    flight.leave()
+                # Si el índice cambió mientras se generaba, la respuesta ya no corresponde
+                if app_state.get('index_version') == version:
+                    await self._put(question, version, count, result)
+                    self.status["computed"] += 1
+        except Exception as e:
+            logger.error(f"Error precalculando respuestas frecuentes: {e}")
+            self.status["error"] = str(e)
+        finally:
+            self.status["running"] = False
+            self.status["finished_at"] = datetime.utcnow()
+            logger.info(f"Precálculo de respuestas terminado: {self.status}")
+
+    def schedule_warm(self, reason: str) -> bool:
+        """Lanza el precálculo en segundo plano; False si no hay base o ya hay uno en curso."""
+        if self.db is None:
+            return False
+        if self._warm_task is not None and not self._warm_task.done():
+            return False
+        self._warm_task = asyncio.create_task(self._warm(reason))
+        return True
+
+    def schedule_after_ingest(self, delay: float):
+        """
+        Precálculo tras una ingesta: cada lote cambia la versión del índice y deja el cache vacío.
+        Los lotes que llegan dentro de `delay` segundos comparten un solo precálculo, que arranca
+        cuando termina el que esté en curso.
+        """
+        if self.db is None or (self._ingest_task is not None and not self._ingest_task.done()):
+            return
+        self._ingest_task = asyncio.create_task(self._warm_after_ingest(delay))
+
+    async def _warm_after_ingest(self, delay: float):
+        await asyncio.sleep(delay)
+        while self._warm_task is not None and not self._warm_task.done():
+            await asyncio.sleep(1.0)
+        self.schedule_warm("ingest")
+
+    async def _loop(self, interval_hours: float):
+        while True:
+            await asyncio.sleep(interval_hours * 3600)
+            self.schedule_warm("scheduled")
+
+    def start(self, interval_hours: float):
+        if interval_hours > 0 and self._loop_task is None:
+            self._loop_task = asyncio.create_task(self._loop(interval_hours))
+
+    async def stop(self):
+        for task in (self._loop_task, self._ingest_task, self._warm_task):
+            if task is not None and not task.done():
+                task.cancel()
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
+        self._loop_task = None
+        self._ingest_task = None
+        self._warm_task = None
+
+    async def snapshot(self) -> Dict[str, Any]:
+        from app.main import app_state
+
+        data = dict(self.status)
+        data["enabled"] = self.db is not None
+        data["index_version"] = app_state.get('index_version')
+        if self.db is not None and data["index_version"]:
+            data["entries"] = await self.db.answer_cache.count_documents({"index_version": data["index_version"]})
+        return data
+
+
+answer_cache = AnswerCache()
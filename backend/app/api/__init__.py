@@ -1,2 +1,2 @@
 # API package
-from . import health, chat, admin, chats
+from . import health, chat, admin, chats, sources
@@ -1,65 +1,213 @@
-from fastapi import APIRouter, HTTPException
+from fastapi import APIRouter, HTTPException, Depends, Header, Request
+from fastapi.responses import PlainTextResponse
+from pydantic import ValidationError
+from app.models import IngestRequest, ProfilerConfigRequest
+from app.profiler import profiler_controller
+from typing import Optional
 from app.excel_loader import ExcelLoader
 from app.rag.documents import dataframes_to_documents
 from app.rag.vectorstore import rebuild_vectorstore
 from app.rag.embeddings import get_embedding_model
 from app.rag.chain import get_rag_chain, get_ollama_llm
+from app.rag.ingest import (
+    IngestLog, TABLES, apply_batch, compact, index_version, ingest_lock,
+    load_tables, parse_csv_rows, replay_log, validate_batch
+)
+from app.answer_cache import answer_cache
+import asyncio
 import logging
+import secrets
 
 logger = logging.getLogger(__name__)
 
 router = APIRouter()
 
 
+def require_admin(x_admin_token: Optional[str] = Header(default=None)):
+    """Exige el header X-Admin-Token; sin ADMIN_TOKEN configurado los endpoints admin quedan cerrados."""
+    from app.config import get_settings
+
+    admin_token = get_settings().admin_token
+    if not admin_token:
+        raise HTTPException(status_code=403, detail="Endpoints de administración deshabilitados: falta configurar ADMIN_TOKEN")
+    if not secrets.compare_digest(x_admin_token or "", admin_token):
+        raise HTTPException(status_code=403, detail="Acceso solo para administradores")
+
+
 @router.post("/rebuild-index")
 async def rebuild_index():
-    """Reconstruye el índice vectorial desde el Excel."""
+    """Reconstruye el índice vectorial desde el Excel y reaplica las ingestas del WAL."""
     from app.main import app_state
     from app.config import get_settings
     
     settings = get_settings()
     
     try:
-        logger.info("Recargando Excel...")
-        loader = ExcelLoader(settings.excel_path)
-        dataframes = loader.load()
-        
-        logger.info("Convirtiendo a documentos...")
-        documents = dataframes_to_documents(dataframes)
-        
-        if not documents:
-            raise HTTPException(
-                status_code=400,
-                detail="No se pudieron generar documentos desde el Excel"
+        async with ingest_lock:
+            logger.info("Recargando Excel...")
+            loader = ExcelLoader(settings.excel_path)
+            log = IngestLog(settings.vectorstore_path)
+            # El Excel no incluye lo ingerido en caliente: se le suma el snapshot compactado
+            dataframes = await asyncio.to_thread(load_tables, loader, log)
+            
+            logger.info("Convirtiendo a documentos...")
+            documents = await asyncio.to_thread(dataframes_to_documents, dataframes)
+            
+            if not documents:
+                raise HTTPException(
+                    status_code=400,
+                    detail="No se pudieron generar documentos desde el Excel"
+                )
+            
+            embeddings = app_state.get('embeddings') or get_embedding_model(settings.embedding_model)
+            
+            logger.info("Reconstruyendo vector store...")
+            vectorstore = await asyncio.to_thread(
+                rebuild_vectorstore,
+                documents,
+                embeddings,
+                settings.vectorstore_path
             )
+            
+            # Los lotes posteriores a la última compactación se reaplican juntos y se compactan
+            if await asyncio.to_thread(replay_log, vectorstore, loader, log):
+                await asyncio.to_thread(compact, vectorstore, log, settings.vectorstore_path)
+            
+            llm = get_ollama_llm(settings.ollama_base_url, settings.ollama_model)
+            chain, retriever = get_rag_chain(vectorstore, llm)
+            
+            app_state['vectorstore'] = vectorstore
+            app_state['embeddings'] = embeddings
+            app_state['loader'] = loader
+            app_state['chain'] = chain
+            app_state['retriever'] = retriever
+            app_state['llm'] = llm
+            app_state['ingest_pending'] = 0
+            app_state['index_generation'] = app_state.get('index_generation', 0) + 1
+            app_state['index_version'] = index_version(settings.vectorstore_path)
         
-        embeddings = get_embedding_model(
-            settings.ollama_base_url,
-            settings.embedding_model
-        )
-        
-        logger.info("Reconstruyendo vector store...")
-        vectorstore = rebuild_vectorstore(
-            documents,
-            embeddings,
-            settings.vectorstore_path
-        )
-        
-        llm = get_ollama_llm(settings.ollama_base_url, settings.ollama_model)
-        chain, retriever = get_rag_chain(vectorstore, llm)
-        
-        app_state['vectorstore'] = vectorstore
-        app_state['chain'] = chain
-        app_state['retriever'] = retriever
+        # Las respuestas cacheadas son de la versión anterior: se precalculan de nuevo en segundo plano
+        answer_cache.schedule_warm("rebuild")
         
         return {
             "status": "success",
             "message": f"Índice reconstruido con {len(documents)} documentos"
         }
         
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error al reconstruir índice: {e}")
         raise HTTPException(
             status_code=500,
             detail=f"Error al reconstruir índice: {str(e)}"
         )
+
+
+@router.post("/ingest", dependencies=[Depends(require_admin)])
+async def ingest(request: Request):
+    """
+    Ingesta incremental sin reconstruir el índice. Acepta JSON
+    {"productos": [...], "clientes": [...], "ventas": [...]} o un CSV multipart
+    (campos `file` y `tabla`). El lote se persiste en el WAL antes de aplicarse y se
+    quita del WAL si no se pudo aplicar.
+    """
+    from app.main import app_state
+    from app.config import get_settings
+
+    settings = get_settings()
+    vectorstore = app_state.get('vectorstore')
+    loader = app_state.get('loader')
+    if vectorstore is None or loader is None:
+        raise HTTPException(status_code=503, detail="Índice no disponible todavía")
+
+    if request.headers.get("content-type", "").startswith("multipart/form-data"):
+        form = await request.form()
+        tabla = form.get("tabla")
+        upload = form.get("file")
+        if tabla not in TABLES or upload is None or isinstance(upload, str):
+            raise HTTPException(status_code=400, detail=f"Se requiere `file` (CSV) y `tabla` ({', '.join(TABLES)})")
+        try:
+            rows = await asyncio.to_thread(parse_csv_rows, await upload.read())
+        except Exception as e:
+            raise HTTPException(status_code=400, detail=f"CSV inválido: {e}")
+        batch = {tabla: rows}
+    else:
+        try:
+            batch = IngestRequest(**await request.json()).dict()
+        except (ValueError, TypeError, ValidationError) as e:
+            raise HTTPException(status_code=422, detail=f"Lote inválido: {e}")
+
+    try:
+        validate_batch(batch)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    async with ingest_lock:
+        # El loader y el índice pueden haber cambiado por un rebuild mientras se esperaba el lock
+        vectorstore = app_state['vectorstore']
+        loader = app_state['loader']
+        log = IngestLog(settings.vectorstore_path)
+        offset = log.size()
+        await asyncio.to_thread(log.append, batch)
+        try:
+            stats = await asyncio.to_thread(apply_batch, vectorstore, loader, batch)
+        except Exception as e:
+            # apply_batch ya deshizo los cambios del loader; el lote sale del WAL para no reaplicarse
+            await asyncio.to_thread(log.truncate, offset)
+            logger.error(f"Error aplicando lote ingerido: {e}")
+            raise HTTPException(status_code=500, detail=f"Error aplicando lote: {str(e)}")
+        app_state['index_generation'] = app_state.get('index_generation', 0) + 1
+        app_state['index_version'] = index_version(settings.vectorstore_path)
+
+        pending = app_state.get('ingest_pending', 0) + 1
+        if pending >= settings.ingest_compact_every:
+            await asyncio.to_thread(compact, vectorstore, log, settings.vectorstore_path)
+            pending = 0
+        app_state['ingest_pending'] = pending
+
+    # El lote invalidó el cache de respuestas frecuentes: se recalcula agrupando ingestas cercanas
+    answer_cache.schedule_after_ingest(settings.answer_cache_ingest_delay)
+
+    return {"status": "success", "pending_compaction": pending, **stats}
+
+
+@router.post("/admin/profiler", dependencies=[Depends(require_admin)])
+async def configure_profiler(req: ProfilerConfigRequest):
+    """
+    Activa o desactiva el profiler por muestreo. Con el profiler activo se perfilan las
+    requests con header X-Profile: 1 y una fracción `sample_rate` del resto.
+    """
+    if not 0.0 <= req.sample_rate <= 1.0:
+        raise HTTPException(status_code=400, detail="sample_rate debe estar entre 0 y 1")
+    profiler_controller.configure(req.enabled, req.sample_rate, profiler_controller.interval)
+    logger.info(f"Profiler {'activado' if req.enabled else 'desactivado'} (sample_rate={req.sample_rate})")
+    return {"enabled": profiler_controller.enabled, "sample_rate": profiler_controller.sample_rate}
+
+
+@router.get("/admin/profiler/profiles", dependencies=[Depends(require_admin)])
+async def list_profiles():
+    """Perfiles guardados (sin el dump), del más reciente al más viejo."""
+    return profiler_controller.list_profiles()
+
+
+@router.get("/admin/profiler/profiles/{trace_id}", response_class=PlainTextResponse, dependencies=[Depends(require_admin)])
+async def get_profile(trace_id: str):
+    """Dump en formato folded stacks, listo para flamegraph.pl o speedscope."""
+    profile = profiler_controller.profiles.get(trace_id)
+    if profile is None:
+        raise HTTPException(status_code=404, detail="Perfil no encontrado")
+    return profile["folded"]
+
+
+@router.post("/admin/answer-cache/warm", dependencies=[Depends(require_admin)])
+async def warm_answer_cache():
+    """Mina las preguntas frecuentes y precalcula en segundo plano las que falten en el cache."""
+    scheduled = answer_cache.schedule_warm("admin")
+    return {"scheduled": scheduled, "status": await answer_cache.snapshot()}
+
+
+@router.get("/admin/answer-cache", dependencies=[Depends(require_admin)])
+async def answer_cache_status():
+    """Estado del último precálculo y entradas para la versión actual del índice."""
+    return await answer_cache.snapshot()
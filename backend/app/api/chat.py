@@ -1,15 +1,118 @@
-from fastapi import APIRouter, HTTPException
-from app.models import ChatRequest, ChatResponse, Source
+from fastapi import APIRouter, HTTPException, Request, Response
+from fastapi.responses import StreamingResponse
+from app.models import ChatBatchRequest, ChatRequest, ChatResponse
+from app.config import get_settings
+from app.metrics import metrics
 from app.rag.chain import query_rag
+from app.rag.retrieval import retrieve_batch
+from app.rag.singleflight import Flight, coalescer, flight_key
+from app.rag.routing import model_router
+from app.rate_limit import batch_limiter, rate_limiter, client_key, apply_headers
+from app.answer_cache import answer_cache
+from app.api.sources import to_response_sources
+from typing import Any, Dict, Optional, Tuple
+import asyncio
+import json
 import logging
+import threading
+import time
 
 logger = logging.getLogger(__name__)
 
 router = APIRouter()
 
+# Generaciones de batch en curso entre todos los jobs: el tope lo pone la capacidad de Ollama
+_batch_slots: Optional[asyncio.Semaphore] = None
+
+
+def batch_slots() -> asyncio.Semaphore:
+    global _batch_slots
+    if _batch_slots is None:
+        _batch_slots = asyncio.Semaphore(get_settings().chat_batch_concurrency)
+    return _batch_slots
+
+
+def request_limits(deadline: Optional[float], max_tokens: Optional[int]) -> Tuple[Optional[float], Optional[int]]:
+    """Deadline (segundos) y máximo de tokens efectivos: lo pedido por el cliente, acotado por la configuración."""
+    settings = get_settings()
+    limit = settings.request_deadline or None
+    if deadline:
+        limit = min(deadline, limit) if limit else deadline
+    tokens = min(max_tokens, settings.ollama_num_predict) if max_tokens else None
+    return limit, tokens
+
+
+async def cached_result(question: str, history: Optional[list], max_tokens: Optional[int]) -> Optional[Dict[str, Any]]:
+    """Respuesta precalculada, solo para preguntas sin historial y sin límite de tokens."""
+    if history or max_tokens is not None:
+        return None
+    return await answer_cache.lookup(question)
+
+
+def start_question_flight(
+    question: str,
+    history: Optional[list[dict]] = None,
+    summary: Optional[str] = None,
+    max_tokens: Optional[int] = None
+) -> Flight:
+    """
+    Lanza (o se une a) la computación RAG de una pregunta.
+    Las preguntas sin historial se coalescen por texto normalizado + generación del índice;
+    con historial la respuesta depende de la conversación y el Flight es privado.
+    """
+    from app.main import app_state
+
+    def factory(on_token, cancel):
+        return query_rag(
+            question=question,
+            chain=app_state['chain'],
+            retriever=app_state['retriever'],
+            reranker=app_state.get('reranker'),
+            history=history,
+            summary=summary,
+            llm=app_state.get('llm'),
+            on_token=on_token,
+            model_router=model_router if model_router.enabled else None,
+            cancel=cancel,
+            max_tokens=max_tokens
+        )
+
+    key = flight_key(question, app_state.get('index_generation', 0), max_tokens)
+    return coalescer.join(key, factory, coalesce=not history and not summary)
+
+
+async def wait_for_flight(flight: Flight, request: Request, deadline: Optional[float]) -> Dict[str, Any]:
+    """
+    Espera el resultado hasta el deadline o hasta que el cliente se desconecte.
+    Al salir, el request deja el Flight: si era el último suscriptor se corta la generación en Ollama.
+    """
+    settings = get_settings()
+
+    async def watch_disconnect():
+        while not await request.is_disconnected():
+            await asyncio.sleep(settings.disconnect_poll_interval)
+
+    result_task = asyncio.ensure_future(flight.result())
+    watcher = asyncio.create_task(watch_disconnect())
+    try:
+        done, _ = await asyncio.wait({result_task, watcher}, timeout=deadline, return_when=asyncio.FIRST_COMPLETED)
+        if result_task in done:
+            return result_task.result()
+        if watcher in done:
+            metrics.incr("requests_cancelled")
+            logger.info("Cliente desconectado, se abandona la consulta")
+            raise HTTPException(status_code=499, detail="Cliente desconectado")
+        metrics.incr("requests_expired")
+        logger.warning(f"Consulta abandonada: excedió el deadline de {deadline}s")
+        raise HTTPException(status_code=504, detail=f"La consulta excedió el tiempo máximo de {deadline:g}s")
+    finally:
+        watcher.cancel()
+        result_task.cancel()
+        flight.leave()
+
 
 @router.post("/chat", response_model=ChatResponse)
-async def chat(request: ChatRequest):
+async def chat(request: ChatRequest, http_request: Request, http_response: Response):
     """Endpoint para hacer preguntas al chatbot."""
     import time
     from app.main import app_state
@@ -24,17 +127,29 @@ async def chat(request: ChatRequest):
             detail="El sistema RAG no está inicializado. Intenta más tarde."
         )
     
+    deadline, max_tokens = request_limits(request.deadline, request.max_tokens)
+    # Un acierto del cache no llega a Ollama: no consume cupo del rate limit
+    cached = await cached_result(request.question, request.history, max_tokens)
+    if cached is not None:
+        logger.info("Respuesta servida desde el cache de preguntas frecuentes")
+        return ChatResponse(
+            answer=cached['answer'],
+            sources=to_response_sources(cached.get('sources', []), request.sources_mode)
+        )
+    limit_state = await rate_limiter.enter(client_key(http_request))
+    apply_headers(http_response, limit_state)
     try:
-        result = await  query_rag(
-            question=request.question,
-            chain=app_state['chain'],
-            retriever=app_state['retriever']
+        flight = start_question_flight(
+            request.question,
+            history=[m.dict() for m in request.history],
+            max_tokens=max_tokens
         )
+        result = await wait_for_flight(flight, http_request, deadline)
         
         
         response = ChatResponse(
             answer=result['answer'],
-            sources=result.get('sources', [])
+            sources=to_response_sources(result.get('sources', []), request.sources_mode)
         )
         
         # Log total request time
@@ -43,9 +158,220 @@ async def chat(request: ChatRequest):
         
         return response
         
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error en chat endpoint: {e}")
         raise HTTPException(
             status_code=500,
             detail=f"Error al procesar la consulta: {str(e)}"
         )
+    finally:
+        await rate_limiter.leave(limit_state)
+
+
+@router.post("/chat/stream")
+async def chat_stream(request: ChatRequest, http_request: Request):
+    """
+    Igual que /chat pero devuelve NDJSON: un evento por token y un evento final
+    con la respuesta completa y las fuentes. Si el cliente corta la conexión,
+    Starlette cancela el generador y el request deja el Flight.
+    """
+    from app.main import app_state
+
+    if not app_state.get('chain') or not app_state.get('retriever'):
+        raise HTTPException(
+            status_code=503,
+            detail="El sistema RAG no está inicializado. Intenta más tarde."
+        )
+
+    deadline, max_tokens = request_limits(request.deadline, request.max_tokens)
+    cached = await cached_result(request.question, request.history, max_tokens)
+    if cached is not None:
+        sources = to_response_sources(cached.get('sources', []), request.sources_mode)
+
+        async def cached_events():
+            yield json.dumps({"type": "token", "content": cached['answer']}) + "\n"
+            yield json.dumps({
+                "type": "done",
+                "answer": cached['answer'],
+                "sources": [s.dict() for s in sources],
+            }, default=str) + "\n"
+
+        return StreamingResponse(cached_events(), media_type="application/x-ndjson")
+
+    # El lugar de concurrencia se libera cuando termina el stream, no al devolver la respuesta
+    limit_state = await rate_limiter.enter(client_key(http_request))
+    try:
+        flight = start_question_flight(
+            request.question,
+            history=[m.dict() for m in request.history],
+            max_tokens=max_tokens
+        )
+    except Exception:
+        await rate_limiter.leave(limit_state)
+        raise
+
+    async def events():
+        loop = asyncio.get_running_loop()
+        deadline_at = loop.time() + deadline if deadline else None
+        finished = False
+
+        def remaining() -> Optional[float]:
+            return None if deadline_at is None else max(0.0, deadline_at - loop.time())
+
+        try:
+            tokens = flight.stream()
+            while True:
+                try:
+                    token = await asyncio.wait_for(anext(tokens), remaining())
+                except StopAsyncIteration:
+                    break
+                yield json.dumps({"type": "token", "content": token}) + "\n"
+            result = await asyncio.wait_for(flight.result(), remaining())
+            sources = to_response_sources(result.get('sources', []), request.sources_mode)
+            finished = True
+            yield json.dumps({
+                "type": "done",
+                "answer": result['answer'],
+                "sources": [s.dict() for s in sources],
+            }, default=str) + "\n"
+        except asyncio.TimeoutError:
+            finished = True
+            metrics.incr("requests_expired")
+            logger.warning(f"Stream abandonado: excedió el deadline de {deadline}s")
+            yield json.dumps({"type": "error", "detail": f"La consulta excedió el tiempo máximo de {deadline:g}s"}) + "\n"
+        except Exception as e:
+            finished = True
+            logger.error(f"Error en chat stream: {e}")
+            yield json.dumps({"type": "error", "detail": f"Error al procesar la consulta: {str(e)}"}) + "\n"
+        finally:
+            if not finished:
+                # El generador se cerró antes de terminar: el cliente se desconectó
+                metrics.incr("requests_cancelled")
+            flight.leave()
+            await rate_limiter.leave(limit_state)
+
+    response = StreamingResponse(events(), media_type="application/x-ndjson")
+    apply_headers(response, limit_state)
+    return response
+
+
+@router.post("/chat/batch")
+async def chat_batch(request: ChatBatchRequest, http_request: Request):
+    """
+    Responde muchas preguntas independientes en un solo request (jobs de reportes).
+    Primero se consulta el cache de preguntas frecuentes; para el resto la recuperación se hace
+    junta (un embedding en lote y una búsqueda FAISS matricial) y las generaciones comparten
+    CHAT_BATCH_CONCURRENCY lugares entre todos los batches en curso.
+    Los jobs tienen su propia cuota (CHAT_BATCH_PER_HOUR, un job a la vez por cliente) en lugar
+    de consumir los tokens de las consultas interactivas.
+    Devuelve NDJSON en orden de finalización: un evento "item" por pregunta (con `index`
+    y `answer` o `error`) y un evento final "summary".
+    """
+    from app.main import app_state
+
+    settings = get_settings()
+    if not app_state.get('chain') or not app_state.get('retriever'):
+        raise HTTPException(
+            status_code=503,
+            detail="El sistema RAG no está inicializado. Intenta más tarde."
+        )
+    questions = request.questions
+    if not questions:
+        raise HTTPException(status_code=400, detail="Se requiere al menos una pregunta")
+    if len(questions) > settings.chat_batch_max_questions:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Máximo {settings.chat_batch_max_questions} preguntas por batch"
+        )
+
+    deadline, max_tokens = request_limits(None, request.max_tokens)
+    limit_state = await batch_limiter.enter(f"batch:{client_key(http_request)}")
+    metrics.incr("chat_batch_items", len(questions))
+
+    async def answer(index: int, question: str, result: Optional[Dict[str, Any]], documents: Optional[list]) -> Dict[str, Any]:
+        item: Dict[str, Any] = {"type": "item", "index": index, "question": question}
+        cancel = threading.Event()
+        try:
+            if result is None:
+                async with batch_slots():
+                    result = await asyncio.wait_for(
+                        query_rag(
+                            question=question,
+                            chain=app_state['chain'],
+                            retriever=app_state['retriever'],
+                            reranker=app_state.get('reranker'),
+                            llm=app_state.get('llm'),
+                            model_router=model_router if model_router.enabled else None,
+                            cancel=cancel,
+                            max_tokens=max_tokens,
+                            documents=documents
+                        ),
+                        timeout=deadline
+                    )
+            sources = to_response_sources(result.get('sources', []), request.sources_mode)
+            item["answer"] = result['answer']
+            item["sources"] = [s.dict() for s in sources]
+        except asyncio.TimeoutError:
+            cancel.set()
+            metrics.incr("requests_expired")
+            item["error"] = f"La consulta excedió el tiempo máximo de {deadline:g}s"
+        except asyncio.CancelledError:
+            cancel.set()
+            raise
+        except Exception as e:
+            logger.error(f"Error en batch (pregunta {index}): {e}")
+            item["error"] = f"Error al procesar la consulta: {str(e)}"
+        if "error" in item:
+            metrics.incr("chat_batch_errors")
+        return item
+
+    async def events():
+        start_time = time.time()
+        tasks: list[asyncio.Task] = []
+        errors = 0
+        finished = False
+        try:
+            cached = await asyncio.gather(*(cached_result(q, None, max_tokens) for q in questions))
+            misses = [i for i, result in enumerate(cached) if result is None]
+            documents: list = [None] * len(questions)
+            if misses:
+                try:
+                    found = await asyncio.to_thread(
+                        retrieve_batch, app_state['retriever'], [questions[i] for i in misses]
+                    )
+                    for i, docs in zip(misses, found):
+                        documents[i] = docs
+                except Exception as e:
+                    # Sin recuperación en lote cada pregunta recupera por su cuenta
+                    logger.warning(f"Recuperación en lote falló, se recupera por pregunta: {e}")
+            metrics.observe("chat_batch_retrieval", time.time() - start_time)
+
+            tasks = [
+                asyncio.create_task(answer(i, q, cached[i], documents[i]))
+                for i, q in enumerate(questions)
+            ]
+            for next_done in asyncio.as_completed(tasks):
+                item = await next_done
+                errors += "error" in item
+                yield json.dumps(item, default=str) + "\n"
+            finished = True
+            yield json.dumps({
+                "type": "summary",
+                "total": len(questions),
+                "cached": len(questions) - len(misses),
+                "errors": errors,
+                "elapsed": round(time.time() - start_time, 3),
+            }) + "\n"
+        finally:
+            if not finished:
+                # Cliente desconectado: se cancelan las generaciones pendientes
+                metrics.incr("requests_cancelled")
+                for task in tasks:
+                    task.cancel()
+            await batch_limiter.leave(limit_state)
+
+    response = StreamingResponse(events(), media_type="application/x-ndjson")
+    apply_headers(response, limit_state)
+    return response
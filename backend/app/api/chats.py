@@ -1,8 +1,17 @@
-from fastapi import APIRouter, HTTPException
+from fastapi import APIRouter, HTTPException, Request, Response
 from bson import ObjectId
 from datetime import datetime
-from app.models import ChatCreateRequest, ChatSummary, ChatDetail, ChatMessage, ChatMessageAddRequest, ChatResponse, Source
-from app.rag.chain import query_rag
+from app.models import ChatCreateRequest, ChatSummary, ChatDetail, ChatMessage, ChatMessageAddRequest, ChatResponse
+from app.api.chat import cached_result, request_limits, start_question_flight, wait_for_flight
+from app.api.sources import expand_message_sources, to_source_refs, to_response_sources
+from app.rag.memory import summarize_messages
+from app.rag.singleflight import coalescer
+from app.config import get_settings
+from app.chat_writer import chat_writer
+from app.tracing import start_span
+from app.rate_limit import rate_limiter, apply_headers
+import asyncio
+import uuid
 import logging
 
 router = APIRouter()
@@ -16,17 +25,22 @@ def oid(id_str: str) -> ObjectId:
         raise HTTPException(status_code=400, detail="chat_id inválido")
 
 
-@router.post("/chats", response_model=ChatDetail)
-async def create_chat(req: ChatCreateRequest):
+def get_db():
     from app.main import app_state
     db = app_state.get('db')
     if db is None:
-        raise HTTPException(status_code=500, detail="DB no inicializada")
+        raise HTTPException(status_code=503, detail="DB no inicializada")
+    return db
+
+
+@router.post("/chats", response_model=ChatDetail)
+async def create_chat(req: ChatCreateRequest):
+    db = get_db()
     now = datetime.utcnow()
     messages = []
     title = "Nuevo chat"
     if req.first_message:
-        messages.append(ChatMessage(role="user", content=req.first_message, ts=now).dict())
+        messages.append(ChatMessage(id=uuid.uuid4().hex, role="user", content=req.first_message, ts=now).dict())
         title = req.first_message[:60]
     doc = {
         "user_id": req.user_id,
@@ -49,73 +63,189 @@ async def create_chat(req: ChatCreateRequest):
 
 @router.get("/chats", response_model=list[ChatSummary])
 async def list_chats(user_id: str):
-    from app.main import app_state
-    db = app_state.get('db')
-    cursor = db.chats.find({"user_id": user_id}).sort("updated_at", -1)
+    db = get_db()
+    cursor = db.chats.find({"user_id": user_id}, {"messages": 0}).sort("updated_at", -1)
     chats = []
     async for c in cursor:
+        c = chat_writer.overlay(c)
         chats.append(ChatSummary(
             id=str(c["_id"]),
             title=c.get("title", "Chat"),
             created_at=c["created_at"],
             updated_at=c["updated_at"],
         ))
+    # El overlay puede haber cambiado updated_at de chats con escrituras pendientes
+    chats.sort(key=lambda chat: chat.updated_at, reverse=True)
     return chats
 
 
 @router.get("/chats/{chat_id}", response_model=ChatDetail)
-async def get_chat(chat_id: str):
-    from app.main import app_state
-    db = app_state.get('db')
-    c = await db.chats.find_one({"_id": oid(chat_id)})
+async def get_chat(chat_id: str, expand_sources: bool = False):
+    db = get_db()
+    chat_oid = oid(chat_id)
+    pending = chat_writer.snapshot(chat_oid)
+    c = chat_writer.overlay(await db.chats.find_one({"_id": chat_oid}), pending)
     if not c:
         raise HTTPException(status_code=404, detail="Chat no encontrado")
     return ChatDetail(
         id=str(c["_id"]),
         user_id=c["user_id"],
         title=c.get("title", "Chat"),
-        messages=[ChatMessage(**m) for m in c.get("messages", [])],
+        # Las fuentes van como referencias (se resuelven con /api/sources/resolve);
+        # expand_sources=true devuelve extractos para clientes que todavía no resuelven
+        messages=[
+            ChatMessage(**m)
+            for m in (expand_message_sources(c.get("messages", [])) if expand_sources else c.get("messages", []))
+        ],
         created_at=c["created_at"],
         updated_at=c["updated_at"],
     )
 
 
+# Resúmenes en curso por chat: uno a la vez por chat y cancelables al cerrar la app
+summary_tasks: dict[ObjectId, asyncio.Task] = {}
+
+
+def schedule_summary(chat_id: ObjectId, user_id: str, messages: list[dict], summarized_count: int, summary: str | None):
+    """
+    Lanza la actualización del resumen solo cuando lo que quedó fuera de la ventana suma
+    SUMMARY_CHUNK_TURNS turnos: así se resume por tandas en vez de llamar al LLM en cada turno.
+    """
+    settings = get_settings()
+    overflow_end = len(messages) - settings.history_window_messages
+    if overflow_end - summarized_count < 2 * max(1, settings.summary_chunk_turns):
+        return
+    running = summary_tasks.get(chat_id)
+    if running is not None and not running.done():
+        return
+    task = asyncio.create_task(update_summary(chat_id, user_id, messages, summarized_count, summary))
+    summary_tasks[chat_id] = task
+    task.add_done_callback(lambda done: summary_tasks.pop(chat_id, None) if summary_tasks.get(chat_id) is done else None)
+
+
+async def stop_summaries():
+    for task in list(summary_tasks.values()):
+        task.cancel()
+    await asyncio.gather(*summary_tasks.values(), return_exceptions=True)
+    summary_tasks.clear()
+
+
+async def update_summary(chat_id: ObjectId, user_id: str, messages: list[dict], summarized_count: int, summary: str | None):
+    """
+    Incorpora al resumen del chat los mensajes que quedaron fuera de la ventana.
+    El resumen y el índice hasta donde cubre se guardan en el documento del chat.
+    La llamada al LLM pasa por el rate limit del usuario y corre como un Flight privado,
+    así cuenta en coalescer.active y el precálculo del cache de respuestas la espera.
+    """
+    from app.main import app_state
+    settings = get_settings()
+    llm = app_state.get('llm')
+    db = app_state.get('db')
+    overflow_end = len(messages) - settings.history_window_messages
+    if llm is None or db is None or overflow_end <= summarized_count:
+        return
+    try:
+        limit_state = await rate_limiter.enter(f"user:{user_id}")
+    except HTTPException:
+        # Sin cupo: el resumen queda pendiente y se reintenta en el próximo turno
+        logger.info(f"Resumen del chat {chat_id} postergado por rate limit")
+        return
+    flight = coalescer.join(
+        f"summary:{chat_id}",
+        lambda on_token, cancel: asyncio.to_thread(
+            summarize_messages,
+            llm,
+            summary,
+            messages[summarized_count:overflow_end],
+            settings.summary_max_tokens,
+        ),
+        coalesce=False,
+    )
+    try:
+        new_summary = await flight.result()
+        await db.chats.update_one(
+            {"_id": chat_id, "summarized_count": {"$in": [summarized_count, None]}},
+            {"$set": {"summary": new_summary, "summarized_count": overflow_end}}
+        )
+        logger.info(f"Resumen del chat {chat_id} actualizado hasta el mensaje {overflow_end}")
+    except asyncio.CancelledError:
+        flight.abort()
+        raise
+    except Exception as e:
+        logger.warning(f"No se pudo actualizar el resumen del chat {chat_id}: {e}")
+    finally:
+        flight.leave()
+        await rate_limiter.leave(limit_state)
+
+
 @router.post("/chats/{chat_id}/message", response_model=ChatResponse)
-async def add_message(chat_id: str, req: ChatMessageAddRequest):
+async def add_message(
+    chat_id: str,
+    req: ChatMessageAddRequest,
+    request: Request,
+    response: Response
+):
     from app.main import app_state
     if not app_state.get('chain') or not app_state.get('retriever'):
         raise HTTPException(status_code=503, detail="RAG no inicializado")
-    db = app_state.get('db')
-    c = await db.chats.find_one({"_id": oid(chat_id), "user_id": req.user_id})
+    db = get_db()
+    chat_oid = oid(chat_id)
+    pending = chat_writer.snapshot(chat_oid)
+    # El historial solo necesita rol y contenido: no se traen las fuentes
+    with start_span("mongo.find_chat"):
+        c = chat_writer.overlay(
+            await db.chats.find_one({"_id": chat_oid, "user_id": req.user_id}, {"messages.sources": 0}),
+            pending
+        )
     if not c:
         raise HTTPException(status_code=404, detail="Chat no encontrado")
     now = datetime.utcnow()
-    user_msg = ChatMessage(role="user", content=req.question, ts=now).dict()
-    result = await query_rag(
-        question=req.question,
-        chain=app_state['chain'],
-        retriever=app_state['retriever'],
-    )
+    user_msg = ChatMessage(id=uuid.uuid4().hex, role="user", content=req.question, ts=now).dict()
+    existing_messages = c.get("messages", [])
+    summarized_count = c.get("summarized_count", 0)
+    deadline, max_tokens = request_limits(req.deadline, req.max_tokens)
+    # El primer mensaje de un chat no tiene historial: puede venir del cache de preguntas frecuentes
+    result = await cached_result(req.question, existing_messages or c.get("summary"), max_tokens)
+    if result is None:
+        limit_state = await rate_limiter.enter(f"user:{req.user_id}")
+        apply_headers(response, limit_state)
+        try:
+            flight = start_question_flight(
+                req.question,
+                history=existing_messages[summarized_count:],
+                summary=c.get("summary"),
+                max_tokens=max_tokens,
+            )
+            # Si el cliente se va o vence el deadline no se guarda nada del turno
+            result = await wait_for_flight(flight, request, deadline)
+        finally:
+            await rate_limiter.leave(limit_state)
     logger.info(f"query_rag result keys: {result.keys()}")
     logger.info(f"Sources returned: {len(result.get('sources', []))} sources")
     if result.get('sources'):
         logger.info(f"First source: {result['sources'][0]}")
     
     assistant_msg = ChatMessage(
+        id=uuid.uuid4().hex,
         role="assistant", 
         content=result['answer'], 
         ts=datetime.utcnow(),
-        sources=[Source(**s) for s in result.get('sources', [])]
     ).dict()
-    existing_messages = c.get("messages", [])
+    # En Mongo solo se guardan referencias compactas; el detalle se resuelve con /api/sources/resolve
+    assistant_msg["sources"] = to_source_refs(result.get('sources', []))
     is_first = len(existing_messages) == 0
     new_messages = existing_messages + [user_msg, assistant_msg]
-    new_title = req.question[:60] if is_first else c.get("title")
-    await db.chats.update_one(
-        {"_id": c["_id"]},
-        {"$set": {"messages": new_messages, "updated_at": datetime.utcnow(), "title": new_title}}
-    )
+    set_fields = {"updated_at": datetime.utcnow()}
+    if is_first:
+        set_fields["title"] = req.question[:60]
+    # La persistencia la hace el write-behind: la respuesta no espera a Mongo
+    with start_span("chat_writer.enqueue"):
+        chat_writer.append(c["_id"], [user_msg, assistant_msg], set_fields)
+    schedule_summary(c["_id"], req.user_id, new_messages, summarized_count, c.get("summary"))
     
-    response = ChatResponse(answer=result['answer'], sources=result.get('sources', []))
-    logger.info(f"ChatResponse created with {len(response.sources)} sources")
-    return response
+    chat_response = ChatResponse(
+        answer=result['answer'],
+        sources=to_response_sources(result.get('sources', []), req.sources_mode)
+    )
+    logger.info(f"ChatResponse created with {len(chat_response.sources)} sources")
+    return chat_response
@@ -1,6 +1,10 @@
-from fastapi import APIRouter
-from app.models import HealthResponse, RunningModelResponse
-import httpx
+from fastapi import APIRouter, Response
+from app.models import HealthResponse, RunningModelResponse, ReadinessResponse
+from app.metrics import metrics
+from app.rag.singleflight import coalescer
+from app.rag.routing import model_router
+from app.startup import startup_tracker
+from app.health_monitor import health_monitor
 import logging
 
 logger = logging.getLogger(__name__)
@@ -10,26 +14,28 @@ router = APIRouter()
 
 @router.get("/ollama-health", response_model=HealthResponse)
 async def health_check():
-    """Endpoint de health check."""
+    """Endpoint de health check. Usa el estado cacheado por el health poller."""
     from app.main import app_state
     
-    ollama_available = False
-    
-    try:
-        if app_state.get('ollama_base_url'):
-            async with httpx.AsyncClient(timeout=5.0) as client:
-                response = await client.get(f"{app_state['ollama_base_url']}/api/tags")
-                ollama_available = response.status_code == 200
-    except:
-        pass
-    
     return HealthResponse(
         status="ok",
         vectorstore_loaded=app_state.get('vectorstore') is not None,
-        ollama_available=ollama_available
+        ollama_available=health_monitor.status["ollama"]["available"]
     )
 
 
+@router.get("/ready", response_model=ReadinessResponse)
+async def readiness_check(response: Response):
+    """Estado y duración de cada etapa de arranque; 503 hasta que las requeridas estén listas."""
+    ready = startup_tracker.ready
+    if not ready:
+        response.status_code = 503
+    return ReadinessResponse(
+        ready=ready,
+        stages=startup_tracker.snapshot(),
+        dependencies=health_monitor.snapshot()
+    )
+
 
 @router.get("/health", response_model=HealthResponse)
 async def health_check():
@@ -50,5 +56,15 @@ async def health_check():
 
     return RunningModelResponse(
         model=ollama_available,
+        models=model_router.models,
     )
     
+
+
+@router.get("/metrics")
+async def get_metrics():
+    """Contadores y latencias en memoria (TTFT, generación, warm-up, coalescing, uso por modelo)."""
+    snapshot = metrics.snapshot()
+    snapshot["singleflight_in_flight"] = coalescer.in_flight
+    snapshot["models"] = model_router.snapshot()
+    return snapshot
@@ -0,0 +1,73 @@
+from fastapi import APIRouter, HTTPException
+from app.models import Source, SourceRef, SourceResolveRequest
+from app.rag.vectorstore import get_documents_by_ids
+from typing import Optional
+import logging
+
+logger = logging.getLogger(__name__)
+
+router = APIRouter()
+
+MAX_RESOLVE_IDS = 200
+# Largo del extracto de contenido que devolvían las fuentes guardadas completas
+EXCERPT_CHARS = 200
+
+
+def to_source_refs(sources: list[dict]) -> list[dict]:
+    """Referencias compactas (doc_id + tipo) para guardar en el historial del chat."""
+    return [SourceRef(doc_id=s.get('doc_id'), type=s.get('type')).dict() for s in sources]
+
+
+def to_response_sources(sources: list[dict], mode: str) -> list[Source]:
+    """En modo 'ids' solo se devuelven las referencias; el frontend las resuelve después."""
+    if mode == "ids":
+        return [Source(doc_id=s.get('doc_id'), type=s.get('type')) for s in sources]
+    return [Source(**s) for s in sources]
+
+
+def expand_message_sources(messages: list[dict]) -> list[dict]:
+    """
+    Compatibilidad para clientes viejos (GET /api/chats/{id}?expand_sources=true): completa las
+    referencias con metadata y un extracto de 200 caracteres, como antes de guardar solo referencias.
+    Devuelve mensajes nuevos: los originales pueden ser los que esperan en el write-behind.
+    """
+    from app.main import app_state
+
+    vectorstore = app_state.get('vectorstore')
+    refs = [s for m in messages for s in (m.get('sources') or []) if s.get('doc_id') and 'content' not in s]
+    if vectorstore is None or not refs:
+        return messages
+    docs = get_documents_by_ids(vectorstore, list(dict.fromkeys(s['doc_id'] for s in refs)))
+    return [
+        {**m, "sources": [
+            _to_source(s['doc_id'], docs[s['doc_id']], EXCERPT_CHARS).dict()
+            if s.get('doc_id') in docs and 'content' not in s else s
+            for s in m['sources']
+        ]} if m.get('sources') else m
+        for m in messages
+    ]
+
+
+def _to_source(doc_id: str, doc, max_chars: Optional[int] = None) -> Source:
+    return Source(
+        id=str(doc.metadata.get('id', doc_id)),
+        doc_id=doc_id,
+        type=doc.metadata.get('tipo', 'unknown'),
+        metadata=doc.metadata,
+        content=doc.page_content[:max_chars] if max_chars else doc.page_content,
+    )
+
+
+@router.post("/sources/resolve", response_model=list[Source])
+async def resolve_sources(req: SourceResolveRequest):
+    """Resuelve en una sola llamada varios doc_id a su contenido en el docstore."""
+    from app.main import app_state
+
+    vectorstore = app_state.get('vectorstore')
+    if vectorstore is None:
+        raise HTTPException(status_code=503, detail="Vector store no inicializado")
+    if len(req.ids) > MAX_RESOLVE_IDS:
+        raise HTTPException(status_code=400, detail=f"Máximo {MAX_RESOLVE_IDS} ids por llamada")
+
+    docs = get_documents_by_ids(vectorstore, list(dict.fromkeys(req.ids)))
+    return [_to_source(doc_id, doc) for doc_id, doc in docs.items()]
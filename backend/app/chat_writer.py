@@ -0,0 +1,157 @@
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+from typing import Any, Dict, List, Optional
+import asyncio
+import logging
+
+from app.tracing import start_span
+
+logger = logging.getLogger(__name__)
+
+
+class ChatWriteBehind:
+    """
+    Cola write-behind en memoria para los mensajes de chat.
+
+    Las escrituras (mensajes nuevos y cambios de updated_at/title) se acumulan por chat
+    y se vuelcan con un único bulk_write al alcanzar max_batch operaciones o cada
+    flush_interval segundos. Las lecturas aplican overlay() para ver sus propias escrituras
+    aunque todavía no estén en Mongo.
+    """
+
+    def __init__(self):
+        self.db = None
+        self.max_batch = 100
+        self.flush_interval = 0.5
+        self._pending: Dict[Any, Dict[str, Any]] = {}
+        self._inflight: Dict[Any, Dict[str, Any]] = {}
+        self._ops = 0
+        self._event = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        self._task: Optional[asyncio.Task] = None
+        self._stopping = False
+
+    def start(self, db, max_batch: int, flush_interval: float):
+        self.db = db
+        self.max_batch = max_batch
+        self.flush_interval = flush_interval
+        if self._task is None:
+            self._task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        """Detiene el loop y drena todo lo pendiente."""
+        # No se cancela la task: un flush en curso debe terminar para no perder el lote
+        self._stopping = True
+        self._event.set()
+        if self._task is not None:
+            await self._task
+            self._task = None
+        for _ in range(3):
+            if not self._pending:
+                break
+            await self.flush()
+        if self._pending:
+            logger.error(f"No se pudieron persistir cambios de {len(self._pending)} chats al cerrar")
+
+    def append(self, chat_id, messages: Optional[List[dict]] = None, set_fields: Optional[dict] = None):
+        entry = self._pending.setdefault(chat_id, {"messages": [], "set": {}})
+        entry["messages"].extend(messages or [])
+        entry["set"].update(set_fields or {})
+        self._ops += 1
+        if self._ops >= self.max_batch:
+            self._event.set()
+
+    def snapshot(self, chat_id) -> Dict[str, Any]:
+        """Escrituras de un chat aún no confirmadas por Mongo (en vuelo + pendientes)."""
+        merged = {"messages": [], "set": {}}
+        for source in (self._inflight, self._pending):
+            entry = source.get(chat_id)
+            if entry:
+                merged["messages"].extend(entry["messages"])
+                merged["set"].update(entry["set"])
+        return merged
+
+    def overlay(self, doc: Optional[dict], earlier: Optional[Dict[str, Any]] = None) -> Optional[dict]:
+        """
+        Aplica al documento leído de Mongo las escrituras todavía no volcadas.
+        `earlier` es un snapshot tomado antes de la lectura, para cubrir un flush
+        que termine mientras la lectura estaba en curso; los mensajes se deduplican por id.
+        """
+        if doc is None:
+            return None
+        current = self.snapshot(doc["_id"])
+        if earlier:
+            current = {
+                "messages": earlier["messages"] + current["messages"],
+                "set": {**earlier["set"], **current["set"]},
+            }
+        if not current["messages"] and not current["set"]:
+            return doc
+
+        doc = dict(doc)
+        messages = list(doc.get("messages", []))
+        seen = {m.get("id") for m in messages if m.get("id")}
+        for message in current["messages"]:
+            if message.get("id") not in seen:
+                messages.append(message)
+                seen.add(message.get("id"))
+        doc["messages"] = messages
+        doc.update(current["set"])
+        return doc
+
+    async def flush(self):
+        async with self._flush_lock:
+            if not self._pending or self.db is None:
+                return
+            self._inflight, self._pending = self._pending, {}
+            self._ops = 0
+
+            chat_ids = []
+            operations = []
+            for chat_id, entry in self._inflight.items():
+                update = {}
+                if entry["messages"]:
+                    update["$push"] = {"messages": {"$each": entry["messages"]}}
+                if entry["set"]:
+                    update["$set"] = entry["set"]
+                if update:
+                    chat_ids.append(chat_id)
+                    operations.append(UpdateOne({"_id": chat_id}, update))
+
+            failed = []
+            try:
+                if operations:
+                    with start_span("mongo.bulk_write", operations=len(operations)):
+                        await self.db.chats.bulk_write(operations, ordered=False)
+                    logger.info(f"Write-behind: {len(operations)} chats persistidos")
+            except BulkWriteError as e:
+                failed = [chat_ids[err["index"]] for err in e.details.get("writeErrors", [])]
+                logger.error(f"bulk_write de chats con {len(failed)} errores, se reintentarán")
+            except Exception as e:
+                failed = chat_ids
+                logger.error(f"Error en bulk_write de chats, se reintentará: {e}")
+            finally:
+                # Reencolar lo fallido delante de lo que llegó mientras tanto
+                for chat_id in failed:
+                    entry = self._inflight[chat_id]
+                    newer = self._pending.get(chat_id, {"messages": [], "set": {}})
+                    self._pending[chat_id] = {
+                        "messages": entry["messages"] + newer["messages"],
+                        "set": {**entry["set"], **newer["set"]},
+                    }
+                self._inflight = {}
+
+    async def _loop(self):
+        while not self._stopping:
+            try:
+                await asyncio.wait_for(self._event.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._event.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"Error en write-behind de chats: {e}")
+
+
+chat_writer = ChatWriteBehind()
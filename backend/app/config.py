@@ -6,12 +6,71 @@ class Settings(BaseSettings):
     excel_path: str = "/data/dataset.xlsx"
     ollama_base_url: str = "http://ollama:11434"
     ollama_model: str = "llama3.2:1b"
+    ollama_models: str = ""
+    route_large_context_chars: int = 0
+    route_large_context_factor: float = 1.5
+    llm_ttft_slo: float = 10.0
+    llm_hedge_enabled: bool = False
+    llm_hedge_delay: float = 4.0
+    ollama_keep_alive: str = "30m"
+    ollama_num_ctx: int = 4096
+    ollama_num_predict: int = 512
+    request_deadline: float = 120.0
+    disconnect_poll_interval: float = 0.5
+    chat_batch_max_questions: int = 500
+    chat_batch_concurrency: int = 4
+    chat_batch_per_hour: float = 30.0
+    chat_batch_burst: int = 3
+    chat_batch_jobs: int = 1
+    rate_limit_enabled: bool = True
+    rate_limit_backend: str = "memory"
+    rate_limit_per_minute: float = 20.0
+    rate_limit_burst: int = 5
+    rate_limit_concurrency: int = 2
+    trusted_proxies: str = ""
+    ollama_warmup: bool = True
+    ollama_warmup_timeout: float = 120.0
     embedding_model: str = "sentence-transformers/all-MiniLM-L6-v2"
     server_port: int = 8000
     vectorstore_path: str = "/data/vectorstore"
     mongo_uri: str = "mongodb://mongodb:27017/retail360"
+    chat_write_batch_size: int = 100
+    chat_write_flush_interval: float = 0.5
+    tracing_enabled: bool = True
+    trace_export: str = "none"
+    trace_export_path: str = "/data/traces/traces.jsonl"
+    trace_export_max_mb: float = 100.0
+    otlp_endpoint: str = "http://localhost:4318/v1/traces"
+    trace_flush_interval: float = 2.0
+    profiler_interval: float = 0.005
+    admin_token: str = ""
+    health_poll_interval: float = 15.0
+    chunk_packing_enabled: bool = True
+    chunk_group_by: str = "cliente"
+    chunk_size: int = 1000
+    ingest_compact_every: int = 20
     retriever_search_type: str = "similarity"
     retriever_k: int = 50
+    context_max_tokens: int = 0
+    multi_query_enabled: bool = True
+    multi_query_max: int = 4
+    rerank_enabled: bool = False
+    reranker_model: str = "cross-encoder/mmarco-mMiniLMv2-L12-H384-v1"
+    rerank_candidates: int = 50
+    rerank_top_n: int = 8
+    rerank_timeout: float = 2.0
+    history_window_messages: int = 6
+    history_max_tokens: int = 800
+    summary_max_tokens: int = 300
+    summary_chunk_turns: int = 3
+    condense_question_enabled: bool = True
+    answer_cache_enabled: bool = True
+    answer_cache_days: int = 14
+    answer_cache_top_n: int = 50
+    answer_cache_min_count: int = 2
+    answer_cache_ttl_days: int = 30
+    answer_cache_warm_interval: float = 24.0
+    answer_cache_ingest_delay: float = 300.0
     
     class Config:
         env_file = ".env"
@@ -8,6 +8,25 @@ import logging
 logger = logging.getLogger(__name__)
 
 
+def _filter_rows(df: pd.DataFrame, id_col: str, ids) -> list:
+    """Filas como dicts, restringidas a `ids` si se indican."""
+    if ids is not None and id_col in df.columns:
+        df = df[df[id_col].isin(list(ids))]
+    return df.to_dict(orient="records")
+
+
+def _upsert(df: pd.DataFrame, rows, id_col: str) -> pd.DataFrame:
+    """Reemplaza las filas con el mismo id y agrega las nuevas."""
+    if not rows:
+        return df
+    new_df = pd.DataFrame(rows)
+    if df is None or df.empty:
+        return new_df.reset_index(drop=True)
+    if id_col in df.columns and id_col in new_df.columns:
+        df = df[~df[id_col].isin(new_df[id_col])]
+    return pd.concat([df, new_df], ignore_index=True)
+
+
 class ExcelLoader:
     def __init__(self, excel_path: str):
         self.excel_path = excel_path
@@ -39,17 +58,57 @@ class ExcelLoader:
             logger.warning(f"No se pudo leer hoja Ventas: {e}")
             self.ventas_df = pd.DataFrame()
 
+        self._prepare()
+        return self.build_documents()
+
+    def _prepare(self):
+        """Normaliza las tablas y genera la vista unida de ventas."""
         self._process_productos()
         self._process_clientes()
         self._process_ventas()
 
         self._join_tables()
 
+    def upsert_rows(self, productos=None, clientes=None, ventas=None):
+        """
+        Inserta o actualiza filas en las tablas ya cargadas (por IdProducto/IdCliente/IdVenta)
+        y recalcula la vista unida con la misma lógica que la carga desde Excel.
+        Devuelve los ids afectados por tabla; las ventas incluyen las que referencian
+        productos o clientes modificados, porque su texto enriquecido cambia.
+        """
+        self.productos_df = _upsert(self.productos_df, productos, "IdProducto")
+        self.clientes_df = _upsert(self.clientes_df, clientes, "IdCliente")
+        self.ventas_df = _upsert(self.ventas_df, ventas, "IdVenta")
+        self._prepare()
+
+        producto_ids = {row.get("IdProducto") for row in productos or []}
+        cliente_ids = {row.get("IdCliente") for row in clientes or []}
+        venta_ids = {row.get("IdVenta") for row in ventas or []}
+        df = self.ventas_completas_df
+        if df is not None and not df.empty and "IdVenta" in df.columns:
+            if producto_ids and "IdProducto" in df.columns:
+                venta_ids |= set(df.loc[df["IdProducto"].isin(producto_ids), "IdVenta"])
+            if cliente_ids and "IdCliente" in df.columns:
+                venta_ids |= set(df.loc[df["IdCliente"].isin(cliente_ids), "IdVenta"])
+        return {"productos": producto_ids, "clientes": cliente_ids, "ventas": venta_ids}
+
+    def tables(self):
+        """Estado de las tablas, para deshacer un upsert_rows que no se pudo completar."""
+        return self.productos_df, self.clientes_df, self.ventas_df, self.ventas_completas_df
+
+    def restore_tables(self, tables):
+        self.productos_df, self.clientes_df, self.ventas_df, self.ventas_completas_df = tables
+
+    def build_documents(self, producto_ids=None, cliente_ids=None, venta_ids=None):
+        """
+        Genera documentos enriquecidos desde las tablas procesadas.
+        Si se pasan ids, solo se generan los de esas filas (None = todas).
+        """
         documentos = []
 
         # Productos
         if self.productos_df is not None and not self.productos_df.empty:
-            for row in self.productos_df.to_dict(orient="records"):
+            for row in _filter_rows(self.productos_df, "IdProducto", producto_ids):
                 contenido = (
                     "[PRODUCTO]\n"
                     f"IdProducto: {row.get('IdProducto')}\n"
@@ -66,7 +125,7 @@ class ExcelLoader:
 
         # Clientes
         if self.clientes_df is not None and not self.clientes_df.empty:
-            for row in self.clientes_df.to_dict(orient="records"):
+            for row in _filter_rows(self.clientes_df, "IdCliente", cliente_ids):
                 contenido = (
                     "[CLIENTE]\n"
                     f"IdCliente: {row.get('IdCliente')}\n"
@@ -82,7 +141,7 @@ class ExcelLoader:
 
         # Ventas completas 
         if self.ventas_completas_df is not None and not self.ventas_completas_df.empty:
-            for row in self.ventas_completas_df.to_dict(orient="records"):
+            for row in _filter_rows(self.ventas_completas_df, "IdVenta", venta_ids):
                 fecha = row.get("FechaVenta") or row.get("fecha")
                 if isinstance(fecha, datetime):
                     fecha_str = fecha.strftime("%Y-%m-%d %H:%M:%S")
@@ -111,14 +170,16 @@ class ExcelLoader:
                             "tipo": "venta",
                             "id": row.get("IdVenta"),
                             "id_producto": row.get('IdProducto') or row.get('IdProducto_producto'),
-                            "id_cliente": row.get('IdCliente') or row.get('IdClient') or row.get('IdCliente_cliente')
+                            "id_cliente": row.get('IdCliente') or row.get('IdClient') or row.get('IdCliente_cliente'),
+                            "fecha": fecha_str[:10],
+                            "total": row.get('Total')
                         }
                     )
                 )
         else:
             # Si no hay join usamos la tabla ventas cruda
             if self.ventas_df is not None and not self.ventas_df.empty:
-                for row in self.ventas_df.to_dict(orient="records"):
+                for row in _filter_rows(self.ventas_df, "IdVenta", venta_ids):
                     fecha = row.get("FechaVenta")
                     contenido = (
                         "[VENTA]\n"
@@ -131,7 +192,13 @@ class ExcelLoader:
                     documentos.append(
                         Document(
                             page_content=contenido,
-                            metadata={"tipo": "venta", "id": row.get("IdVenta")}
+                            metadata={
+                                "tipo": "venta",
+                                "id": row.get("IdVenta"),
+                                "id_producto": row.get('IdProducto'),
+                                "id_cliente": row.get('IdCliente') or row.get('IdClient'),
+                                "fecha": str(fecha)[:10]
+                            }
                         )
                     )
 
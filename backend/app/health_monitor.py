@@ -0,0 +1,87 @@
+from typing import Any, Dict, Optional
+import asyncio
+import httpx
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class HealthMonitor:
+    """
+    Consulta periódicamente Ollama y MongoDB en segundo plano y cachea el resultado,
+    así los probes de salud responden sin hacer llamadas de red.
+    """
+
+    def __init__(self):
+        self.status: Dict[str, Dict[str, Any]] = {
+            "ollama": {"available": False, "checked_at": None, "latency": None, "error": None},
+            "mongo": {"available": False, "checked_at": None, "latency": None, "error": None},
+        }
+        self._task: Optional[asyncio.Task] = None
+
+    def _record(self, name: str, available: bool, start_time: float, error: Optional[str] = None):
+        self.status[name] = {
+            "available": available,
+            "checked_at": time.time(),
+            "latency": round(time.time() - start_time, 4),
+            "error": error,
+        }
+
+    async def check_ollama(self, base_url: Optional[str]):
+        start_time = time.time()
+        if not base_url:
+            self._record("ollama", False, start_time, "ollama_base_url no configurada")
+            return
+        try:
+            async with httpx.AsyncClient(timeout=5.0) as client:
+                response = await client.get(f"{base_url}/api/tags")
+            self._record("ollama", response.status_code == 200, start_time)
+        except Exception as e:
+            self._record("ollama", False, start_time, str(e))
+
+    async def check_mongo(self, db: Any):
+        start_time = time.time()
+        if db is None:
+            self._record("mongo", False, start_time, "DB no inicializada")
+            return
+        try:
+            await asyncio.wait_for(db.command("ping"), timeout=5.0)
+            self._record("mongo", True, start_time)
+        except Exception as e:
+            self._record("mongo", False, start_time, str(e))
+
+    async def poll(self):
+        from app.main import app_state
+
+        await asyncio.gather(
+            self.check_ollama(app_state.get('ollama_base_url')),
+            self.check_mongo(app_state.get('db')),
+        )
+
+    async def _loop(self, interval: float):
+        while True:
+            try:
+                await self.poll()
+            except Exception as e:
+                logger.warning(f"Error en health poller: {e}")
+            await asyncio.sleep(interval)
+
+    def start(self, interval: float):
+        if self._task is None:
+            self._task = asyncio.create_task(self._loop(interval))
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def snapshot(self) -> Dict[str, Dict[str, Any]]:
+        return {name: dict(status) for name, status in self.status.items()}
+
+
+health_monitor = HealthMonitor()
@@ -1,6 +1,7 @@
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from contextlib import asynccontextmanager
+import asyncio
 import logging
 import sys
 from motor.motor_asyncio import AsyncIOMotorClient
@@ -9,9 +10,19 @@ from app.config import get_settings
 from app.excel_loader import ExcelLoader
 from app.rag.documents import dataframes_to_documents
 from app.rag.embeddings import get_embedding_model
-from app.rag.vectorstore import load_vectorstore_or_build
-from app.rag.chain import get_rag_chain, get_ollama_llm
-from app.api import health, chat, admin, chats
+from app.rag.vectorstore import build_vectorstore, load_vectorstore
+from app.rag.chain import get_rag_chain, get_ollama_llm, warmup_ollama
+from app.rag.rerank import get_cross_encoder
+from app.rag.routing import model_router
+from app.rag.ingest import IngestLog, compact, index_version, ingest_lock, load_tables, replay_log
+from app.startup import startup_tracker
+from app.health_monitor import health_monitor
+from app.chat_writer import chat_writer
+from app.rate_limit import batch_limiter, rate_limiter
+from app.answer_cache import answer_cache
+from app.tracing import TracingMiddleware, trace_exporter
+from app.profiler import profiler_controller
+from app.api import health, chat, admin, chats, sources
 
 logging.basicConfig(
     level=logging.INFO,
@@ -24,14 +35,19 @@ logger = logging.getLogger(__name__)
 app_state = {}
 
 
-@asynccontextmanager
-async def lifespan(app: FastAPI):
-    settings = get_settings()
-    
-    logger.info("Iniciando aplicación...")
-    logger.info(f"Configuración: {settings.dict()}")
-    
-    try:
+async def run_startup(app: FastAPI, settings):
+    """
+    Arranque progresivo: las etapas independientes corren en paralelo
+    (Mongo, parseo del Excel, carga de embeddings, re-ranker y warm-up de Ollama)
+    y el estado de cada una queda disponible en /api/ready.
+    """
+    tracker = startup_tracker
+    for name in ("mongo", "documents", "embeddings", "vectorstore", "ingest_replay", "chain"):
+        tracker.register(name)
+    tracker.register("reranker", required=settings.rerank_enabled)
+    tracker.register("ollama_warmup", required=False)
+
+    async def connect_mongo():
         logger.info("Conectando a MongoDB")
         mongo_client = AsyncIOMotorClient(settings.mongo_uri)
         db_name = getattr(settings, "mongo_db_name", None) or "retail360"
@@ -43,52 +59,186 @@ async def lifespan(app: FastAPI):
         app.state.mongo_client = mongo_client
         app.state.db = db
         app_state['db'] = db
-        await db.chats.create_index("user_id")
-        
+        chat_writer.start(db, settings.chat_write_batch_size, settings.chat_write_flush_interval)
+        await rate_limiter.attach(db)
+        await batch_limiter.attach(db)
+        await answer_cache.attach(db, settings.answer_cache_enabled, settings.answer_cache_ttl_days)
+
+    async def load_documents():
         logger.info(f"Cargando Excel desde {settings.excel_path}")
         loader = ExcelLoader(settings.excel_path)
-        dataframes = loader.load()
-        
+        # Excel + filas ingeridas ya compactadas en el snapshot
+        dataframes = await asyncio.to_thread(load_tables, loader, IngestLog(settings.vectorstore_path))
+        app_state['loader'] = loader
+
         logger.info("Convirtiendo datos a documentos...")
-        documents = dataframes_to_documents(dataframes)
+        documents = await asyncio.to_thread(dataframes_to_documents, dataframes)
         logger.info(f"Generados {len(documents)} documentos")
-        
+
         if not documents:
             logger.error("No se generaron documentos desde el Excel")
             raise Exception("No se pudieron generar documentos")
-        
+        return documents
+
+    async def load_embeddings():
         logger.info("Inicializando embeddings...")
-        embeddings = get_embedding_model(settings.embedding_model)
-        
-        logger.info("Cargando/construyendo vector store...")
-        vectorstore = load_vectorstore_or_build(
-            documents,
-            embeddings,
-            settings.vectorstore_path
-        )
-        
-        logger.info("Inicializando LLM de Ollama...")
-        llm = get_ollama_llm(settings.ollama_base_url, settings.ollama_model)
-        
-        logger.info("Construyendo RAG chain...")
-        chain, retriever = get_rag_chain(vectorstore, llm)
-        
-        app_state['vectorstore'] = vectorstore
-        app_state['chain'] = chain
-        app_state['retriever'] = retriever
-        app_state['ollama_base_url'] = settings.ollama_base_url
-        app_state['settings'] = settings
-        app_state['ollama_model'] = settings.ollama_model
-        
+        return await asyncio.to_thread(get_embedding_model, settings.embedding_model)
+
+    async def load_reranker():
+        logger.info("Cargando cross-encoder para re-rank...")
+        app_state['reranker'] = await asyncio.to_thread(get_cross_encoder, settings.reranker_model)
+
+    async def warmup():
+        # Se precalientan todos los modelos de routing (Ollama debe poder tenerlos cargados a la vez)
+        results = await asyncio.gather(*(
+            warmup_ollama(settings.ollama_base_url, model) for model in model_router.models
+        ))
+        if not all(results):
+            raise Exception("Warm-up de Ollama falló")
+
+    mongo_task = asyncio.create_task(tracker.run("mongo", connect_mongo))
+    documents_task = asyncio.create_task(tracker.run("documents", load_documents))
+    embeddings_task = asyncio.create_task(tracker.run("embeddings", load_embeddings))
+    optional_tasks = [mongo_task]
+    if settings.rerank_enabled:
+        optional_tasks.append(asyncio.create_task(tracker.run("reranker", load_reranker)))
+    else:
+        tracker.skip("reranker", "rerank_enabled=false")
+    if settings.ollama_warmup:
+        optional_tasks.append(asyncio.create_task(tracker.run("ollama_warmup", warmup)))
+    else:
+        tracker.skip("ollama_warmup", "ollama_warmup=false")
+
+    logger.info("Inicializando LLM de Ollama...")
+    llm = get_ollama_llm(settings.ollama_base_url, settings.ollama_model)
+    app_state['llm'] = llm
+
+    # El índice en disco solo necesita los embeddings: se carga mientras se parsea el Excel
+    # y los documentos se esperan únicamente si hay que reconstruirlo o reaplicar el WAL
+    embeddings = (await asyncio.gather(embeddings_task, return_exceptions=True))[0]
+    if isinstance(embeddings, Exception):
+        tracker.skip("vectorstore", "embeddings no disponibles")
+        tracker.skip("ingest_replay", "vector store no disponible")
+        tracker.skip("chain", "vector store no disponible")
+    else:
+        async def load_or_build_vectorstore():
+            logger.info("Cargando vector store desde disco...")
+            vectorstore = await asyncio.to_thread(load_vectorstore, embeddings, settings.vectorstore_path)
+            if vectorstore is not None:
+                return vectorstore
+            documents = await documents_task
+            logger.info("Construyendo vector store...")
+            return await asyncio.to_thread(build_vectorstore, documents, embeddings, settings.vectorstore_path)
+
+        async def replay_ingest():
+            log = IngestLog(settings.vectorstore_path)
+            if log.size() > 0:
+                # Reaplicar lotes necesita las tablas del loader
+                await documents_task
+                app_state['ingest_pending'] = await asyncio.to_thread(
+                    replay_log, vectorstore, app_state['loader'], log
+                )
+            else:
+                app_state['ingest_pending'] = 0
+            app_state['index_version'] = index_version(settings.vectorstore_path)
+
+        async def build_chain():
+            logger.info("Construyendo RAG chain...")
+            chain, retriever = get_rag_chain(vectorstore, llm)
+            app_state['vectorstore'] = vectorstore
+            app_state['embeddings'] = embeddings
+            app_state['chain'] = chain
+            app_state['retriever'] = retriever
+
+        try:
+            vectorstore = await tracker.run("vectorstore", load_or_build_vectorstore)
+            await tracker.run("ingest_replay", replay_ingest)
+            await tracker.run("chain", build_chain)
+        except Exception:
+            if tracker.stages["ingest_replay"].status == "pending":
+                tracker.skip("ingest_replay", "vector store no disponible")
+            if tracker.stages["chain"].status == "pending":
+                tracker.skip("chain", "vector store no disponible")
+
+    # El parseo del Excel termina aunque el índice ya esté listo: el ingest necesita el loader
+    optional_tasks.append(documents_task)
+    await asyncio.gather(*optional_tasks, return_exceptions=True)
+
+    if tracker.ready:
         logger.info("Aplicación iniciada correctamente")
-        
-        yield
-        
-    except Exception as e:
-        logger.error(f"Error al iniciar aplicación: {e}")
-        yield
+        # Tras un deploy solo se calculan las preguntas frecuentes que no estén en el cache
+        answer_cache.schedule_warm("startup")
+    else:
+        logger.error(f"Aplicación iniciada parcialmente: {tracker.snapshot()}")
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    settings = get_settings()
+    
+    logger.info("Iniciando aplicación...")
+    logger.info(f"Configuración: {settings.dict()}")
+    
+    app_state['ollama_base_url'] = settings.ollama_base_url
+    app_state['settings'] = settings
+    app_state['ollama_model'] = settings.ollama_model
+    app_state['reranker'] = None
+    app_state['index_generation'] = 0
+    model_router.configure(settings.ollama_base_url, settings.ollama_model, settings.ollama_models)
+    rate_limiter.configure(
+        settings.rate_limit_enabled,
+        settings.rate_limit_backend,
+        settings.rate_limit_per_minute,
+        settings.rate_limit_burst,
+        settings.rate_limit_concurrency,
+        # Una reserva no puede durar más que la consulta más larga permitida
+        (settings.request_deadline or 600.0) + 30.0,
+        settings.trusted_proxies
+    )
+    # La cuota de batch cuenta jobs (por hora), no preguntas
+    batch_limiter.configure(
+        settings.rate_limit_enabled,
+        settings.rate_limit_backend,
+        settings.chat_batch_per_hour / 60.0,
+        settings.chat_batch_burst,
+        settings.chat_batch_jobs,
+        # Un job dura a lo sumo sus preguntas en tandas de CHAT_BATCH_CONCURRENCY
+        (settings.request_deadline or 600.0) * -(-settings.chat_batch_max_questions // max(1, settings.chat_batch_concurrency)) + 30.0,
+        settings.trusted_proxies
+    )
+    
+    # El arranque corre en segundo plano: la app acepta tráfico de inmediato
+    # y los endpoints responden 503 hasta que sus dependencias estén listas
+    startup_task = asyncio.create_task(run_startup(app, settings))
+    health_monitor.start(settings.health_poll_interval)
+    trace_exporter.configure(
+        settings.trace_export if settings.tracing_enabled else "none",
+        settings.trace_export_path,
+        settings.otlp_endpoint,
+        int(settings.trace_export_max_mb * 1024 * 1024)
+    )
+    trace_exporter.start(settings.trace_flush_interval)
+    profiler_controller.configure(False, 0.0, settings.profiler_interval)
+    answer_cache.start(settings.answer_cache_warm_interval)
+    
+    yield
     
     logger.info("Cerrando aplicación...")
+    startup_task.cancel()
+    await answer_cache.stop()
+    if app_state.get('ingest_pending') and app_state.get('vectorstore') is not None:
+        # Lotes ingeridos desde la última compactación: se guardan para no reaplicarlos al arrancar
+        async with ingest_lock:
+            await asyncio.to_thread(
+                compact, app_state['vectorstore'], IngestLog(settings.vectorstore_path), settings.vectorstore_path
+            )
+    await chats.stop_summaries()
+    await health_monitor.stop()
+    await chat_writer.stop()
+    await trace_exporter.stop()
+    mongo_client = getattr(app.state, "mongo_client", None)
+    if mongo_client is not None:
+        mongo_client.close()
 
 
 app = FastAPI(
@@ -104,12 +254,17 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["RateLimit-Limit", "RateLimit-Remaining", "RateLimit-Reset", "RateLimit-Policy", "Retry-After"],
 )
 
+if get_settings().tracing_enabled:
+    app.add_middleware(TracingMiddleware)
+
 app.include_router(health.router, prefix="/api", tags=["health"])
 app.include_router(chat.router, prefix="/api", tags=["chat"])
 app.include_router(admin.router, prefix="/api", tags=["admin"])
 app.include_router(chats.router, prefix="/api", tags=["chats"])
+app.include_router(sources.router, prefix="/api", tags=["sources"])
 
 
 @app.get("/")
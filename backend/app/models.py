@@ -1,39 +1,69 @@
 from pydantic import BaseModel
-from typing import Literal, List, Optional
+from typing import Any, Dict, Literal, List, Optional
 from datetime import datetime
 
 
 class ChatMessage(BaseModel):
+    id: Optional[str] = None
     role: Literal["user", "assistant"]
     content: str
     ts: Optional[datetime] = None
     sources: Optional[List['Source']] = None
 
 
+SourcesMode = Literal["full", "ids"]
+
+
 class ChatRequest(BaseModel):
     question: str
     history: list[ChatMessage] = []
+    sources_mode: SourcesMode = "full"
+    deadline: Optional[float] = None
+    max_tokens: Optional[int] = None
+
+
+class ChatBatchRequest(BaseModel):
+    questions: List[str]
+    sources_mode: SourcesMode = "ids"
+    max_tokens: Optional[int] = None
 
 
 class Source(BaseModel):
     id: str | None = None
+    doc_id: str | None = None
     type: str | None = None
     metadata: dict = {}
     content: str | None = None
 
 
+class SourceRef(BaseModel):
+    doc_id: str | None = None
+    type: str | None = None
+
+
 class ChatResponse(BaseModel):
     answer: str
     sources: List[Source] = []
 
 
+class SourceResolveRequest(BaseModel):
+    ids: List[str]
+
+
 class HealthResponse(BaseModel):
     status: str
     vectorstore_loaded: bool = False
     ollama_available: bool = False
 
+
+class ReadinessResponse(BaseModel):
+    ready: bool
+    stages: dict = {}
+    dependencies: dict = {}
+
 class RunningModelResponse(BaseModel):
     model: str
+    models: List[str] = []
 
 class ChatCreateRequest(BaseModel):
     user_id: str
@@ -59,3 +89,17 @@ class ChatDetail(BaseModel):
 class ChatMessageAddRequest(BaseModel):
     user_id: str
     question: str
+    sources_mode: SourcesMode = "full"
+    deadline: Optional[float] = None
+    max_tokens: Optional[int] = None
+
+
+class ProfilerConfigRequest(BaseModel):
+    enabled: bool
+    sample_rate: float = 0.0
+
+
+class IngestRequest(BaseModel):
+    productos: List[Dict[str, Any]] = []
+    clientes: List[Dict[str, Any]] = []
+    ventas: List[Dict[str, Any]] = []
@@ -0,0 +1,109 @@
+from collections import Counter, OrderedDict
+from typing import Dict, List, Optional
+import random
+import sys
+import threading
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class SamplingProfiler:
+    """
+    Profiler por muestreo: cada `interval` segundos toma el stack de todos los threads
+    del proceso (loop de asyncio y threadpool) y acumula stacks en formato "folded",
+    listo para flamegraph.pl / speedscope.
+    """
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.samples: Counter = Counter()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def _sample(self):
+        own_id = threading.get_ident()
+        names = {t.ident: t.name for t in threading.enumerate()}
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == own_id:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({code.co_filename.rsplit('/', 1)[-1]}:{frame.f_lineno})")
+                frame = frame.f_back
+            stack.append(names.get(thread_id, str(thread_id)))
+            self.samples[";".join(reversed(stack))] += 1
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._sample()
+            time.sleep(self.interval)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> str:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        return "\n".join(f"{stack} {count}" for stack, count in self.samples.most_common())
+
+
+class ProfilerController:
+    """
+    Estado del toggle de profiling (solo admin). Se perfila una request a la vez para
+    acotar el overhead; los dumps quedan guardados por trace_id.
+    """
+
+    def __init__(self, max_profiles: int = 20):
+        self.enabled = False
+        self.sample_rate = 0.0
+        self.interval = 0.005
+        self.max_profiles = max_profiles
+        self.profiles: "OrderedDict[str, Dict]" = OrderedDict()
+        self._busy = threading.Lock()
+
+    def configure(self, enabled: bool, sample_rate: float, interval: float):
+        self.enabled = enabled
+        self.sample_rate = sample_rate
+        self.interval = interval
+
+    def should_profile(self, forced: bool) -> bool:
+        if not self.enabled:
+            return False
+        return forced or random.random() < self.sample_rate
+
+    def acquire(self) -> Optional[SamplingProfiler]:
+        if not self._busy.acquire(blocking=False):
+            return None
+        profiler = SamplingProfiler(self.interval)
+        profiler.start()
+        return profiler
+
+    def release(self, profiler: SamplingProfiler, trace_id: str, path: str, duration: float):
+        try:
+            folded = profiler.stop()
+        finally:
+            self._busy.release()
+        self.profiles[trace_id] = {
+            "trace_id": trace_id,
+            "path": path,
+            "duration": round(duration, 4),
+            "samples": sum(profiler.samples.values()),
+            "folded": folded,
+        }
+        while len(self.profiles) > self.max_profiles:
+            self.profiles.popitem(last=False)
+        logger.info(f"Profile guardado para trace {trace_id} ({path}, {duration:.2f}s)")
+
+    def list_profiles(self) -> List[Dict]:
+        return [
+            {k: v for k, v in profile.items() if k != "folded"}
+            for profile in reversed(self.profiles.values())
+        ]
+
+
+profiler_controller = ProfilerController()
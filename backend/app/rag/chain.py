@@ -1,31 +1,236 @@
 from langchain.vectorstores import FAISS
-from langchain.prompts import ChatPromptTemplate
+from langchain.prompts import PromptTemplate
 from langchain.schema.output_parser import StrOutputParser
 from langchain_community.llms import Ollama
-from typing import Dict, Any, List, Optional
+from typing import Callable, Dict, Any, List, Optional
 import logging
 import asyncio
+import threading
 from app.config import get_settings
+from app.metrics import metrics
+from app.tracing import start_span
+from app.rag.rerank import rerank_documents
+from app.rag.retrieval import retrieve_documents, retrieve_multi, split_question
+from app.rag.memory import select_window, format_history, condense_question, estimate_tokens, truncate_to_tokens
 
 logger = logging.getLogger(__name__)
 
 
+# Prefijo estático del prompt: debe quedar idéntico byte a byte entre requests
+# para que Ollama reutilice su KV cache. Todo lo variable va después.
+SYSTEM_PREFIX = """Sos un asistente que responde sobre un dataset de ventas de Retail 360.
+
+Usa EXCLUSIVAMENTE la información del CONTEXTO que aparece más abajo para responder la pregunta.
+Si la respuesta no está en el contexto, respondé explícitamente "No tengo suficiente información en los datos para responder esa pregunta."
+NO inventes números, clientes, productos ni datos que no estén en el contexto.
+El HISTORIAL sirve solo para entender a qué se refiere la pregunta.
+"""
+
+RAG_TEMPLATE = SYSTEM_PREFIX + """
+HISTORIAL:
+{history}
+
+CONTEXTO:
+{context}
+
+PREGUNTA: {question}
+
+RESPUESTA:"""
+
+
+def parse_keep_alive(keep_alive: str) -> Optional[float]:
+    """Convierte un keep_alive de Ollama ("30m", "1h", "300") a segundos; None = infinito."""
+    value = str(keep_alive).strip()
+    if value.startswith("-"):
+        return None
+    units = {"s": 1, "m": 60, "h": 3600}
+    if value and value[-1] in units:
+        return float(value[:-1]) * units[value[-1]]
+    return float(value)
+
+
 def get_ollama_llm(base_url: str, model: str) -> Ollama:
     """Crea una instancia del LLM de Ollama."""
+    settings = get_settings()
     logger.info(f"Creating Ollama LLM instance - base_url: {base_url}, model: {model}")
+    kwargs = {}
+    # keep_alive solo existe en versiones recientes de langchain_community;
+    # en las demás lo fija OLLAMA_KEEP_ALIVE en el servidor y el warm-up
+    if "keep_alive" in Ollama.__fields__:
+        kwargs["keep_alive"] = settings.ollama_keep_alive
     llm = Ollama(
         base_url=base_url,
         model=model,
         temperature=0.1,  # Baja temperatura para respuestas más precisas
+        num_ctx=settings.ollama_num_ctx,
+        num_predict=settings.ollama_num_predict,
+        **kwargs
     )
     logger.info("Ollama LLM instance created successfully")
     return llm
 
 
+async def warmup_ollama(base_url: str, model: str) -> bool:
+    """
+    Carga el modelo en Ollama y precalienta el prefijo estático del prompt.
+    Usa las mismas opciones que las consultas reales para que Ollama no recargue el modelo.
+    """
+    import time
+    import httpx
+
+    settings = get_settings()
+    payload = {
+        "model": model,
+        "prompt": SYSTEM_PREFIX,
+        "stream": False,
+        "keep_alive": settings.ollama_keep_alive,
+        "options": {
+            "temperature": 0.1,
+            "num_ctx": settings.ollama_num_ctx,
+            "num_predict": 1,
+        },
+    }
+    try:
+        logger.info(f"Warming up Ollama model {model}...")
+        start_time = time.time()
+        async with httpx.AsyncClient(timeout=settings.ollama_warmup_timeout) as client:
+            response = await client.post(f"{base_url}/api/generate", json=payload)
+            response.raise_for_status()
+        warmup_time = time.time() - start_time
+        metrics.observe(f"llm_warmup.{model}", warmup_time)
+        mark_model_used(model)
+        logger.info(f"Ollama model {model} warmed up in {warmup_time:.2f}s")
+        return True
+    except Exception as e:
+        logger.warning(f"No se pudo precalentar el modelo {model}: {e}")
+        return False
+
+
+_model_last_used: Dict[str, float] = {}
+
+
+def mark_model_used(model: str):
+    import time
+    _model_last_used[model] = time.time()
+
+
+def is_model_warm(model: str) -> bool:
+    """Estima si Ollama todavía tiene el modelo cargado según el keep_alive configurado."""
+    import time
+
+    last_used = _model_last_used.get(model)
+    if last_used is None:
+        return False
+    keep_alive = parse_keep_alive(get_settings().ollama_keep_alive)
+    return keep_alive is None or time.time() - last_used < keep_alive
+
+
+class GenerationCancelled(Exception):
+    """La generación se cortó antes de terminar (otro intento ganó o se venció el plazo)."""
+
+
+def generate_answer(
+    chain,
+    inputs: Dict[str, Any],
+    model: str,
+    on_token: Optional[Callable[[str], None]] = None,
+    cancel: Optional[threading.Event] = None,
+    max_tokens: Optional[int] = None
+) -> str:
+    """
+    Ejecuta la chain en streaming para medir el time to first token (TTFT),
+    separando caminos fríos (modelo descargado) y calientes.
+    Si `cancel` se activa, se cierra el stream en el siguiente token (Ollama corta
+    la generación al cerrarse la conexión) y se lanza GenerationCancelled.
+    Con `max_tokens` la respuesta se corta al llegar a esa cantidad de chunks (~tokens).
+    """
+    import time
+
+    warm = is_model_warm(model)
+    path = "warm" if warm else "cold"
+    metrics.incr(f"llm_requests.{model}")
+    with start_span("llm.generate", model=model, path=path) as span:
+        start_time = time.time()
+        first_token_time = None
+        parts: List[str] = []
+        stream = chain.stream(inputs)
+        try:
+            for chunk in stream:
+                if cancel is not None and cancel.is_set():
+                    span.set_attribute("cancelled", True)
+                    metrics.incr(f"llm_cancelled.{model}")
+                    raise GenerationCancelled(f"Generación con {model} cancelada")
+                if first_token_time is None:
+                    first_token_time = time.time() - start_time
+                    span.set_attribute("ttft_ms", round(first_token_time * 1000, 1))
+                parts.append(chunk)
+                if on_token is not None:
+                    on_token(chunk)
+                if max_tokens is not None and len(parts) >= max_tokens:
+                    span.set_attribute("truncated", True)
+                    metrics.incr("llm_truncated")
+                    break
+        finally:
+            stream.close()
+        total_time = time.time() - start_time
+        span.set_attribute("chunks", len(parts))
+    mark_model_used(model)
+
+    if first_token_time is not None:
+        metrics.observe(f"llm_ttft_{path}", first_token_time)
+        metrics.observe(f"llm_ttft.{model}", first_token_time)
+        logger.info(f"LLM TTFT ({path}, {model}): {first_token_time:.2f}s, total: {total_time:.2f}s")
+    metrics.observe("llm_generation", total_time)
+    metrics.observe(f"llm_generation.{model}", total_time)
+    metrics.incr(f"llm_chunks.{model}", len(parts))
+    return "".join(parts)
+
+
+def context_budget(question: str, history: str) -> int:
+    """
+    Tokens disponibles para el contexto: lo que queda de OLLAMA_NUM_CTX después del prompt fijo,
+    el historial, la pregunta y la respuesta (OLLAMA_NUM_PREDICT). Si el prompt no entra, Ollama
+    lo recorta por el principio y se pierden las instrucciones. CONTEXT_MAX_TOKENS lo acota más.
+    """
+    settings = get_settings()
+    budget = (
+        settings.ollama_num_ctx
+        - settings.ollama_num_predict
+        - estimate_tokens(RAG_TEMPLATE)
+        - estimate_tokens(history)
+        - estimate_tokens(question)
+    )
+    if settings.context_max_tokens > 0:
+        budget = min(budget, settings.context_max_tokens)
+    return max(0, budget)
+
+
+def fit_context(docs: List[Any], max_tokens: int) -> List[Any]:
+    """Primeros documentos (en orden de relevancia) que entran en el presupuesto; al menos uno."""
+    kept: List[Any] = []
+    used = 0
+    for doc in docs:
+        cost = estimate_tokens(doc.page_content) + 1
+        if kept and used + cost > max_tokens:
+            break
+        kept.append(doc)
+        used += cost
+    return kept
+
+
 def format_docs(docs: List[Any]) -> str:
     return "\n\n".join(doc.page_content for doc in docs)
 
 
+def build_llm_chain(llm: Ollama):
+    """
+    Prompt de texto plano | LLM | parser. El prompt llega a Ollama sin prefijos de rol,
+    así SYSTEM_PREFIX es exactamente el inicio de cada request.
+    """
+    prompt = PromptTemplate.from_template(RAG_TEMPLATE)
+    return prompt | llm | StrOutputParser()
+
+
 def get_rag_chain(vectorstore: FAISS, llm: Ollama):
     """
     Construye la chain RAG para recibir contexto explícito.
@@ -34,34 +239,18 @@ def get_rag_chain(vectorstore: FAISS, llm: Ollama):
     logger.info("Building RAG chain...")
     
     logger.info("Creating retriever...")
+    # Con re-rank activo se sobre-recuperan candidatos para el cross-encoder
+    k = settings.retriever_k
+    if settings.rerank_enabled:
+        k = max(k, settings.rerank_candidates)
     retriever = vectorstore.as_retriever(
         search_type=settings.retriever_search_type,
-        search_kwargs={"k": settings.retriever_k}
+        search_kwargs={"k": k}
     )
-    logger.info(f"Retriever created successfully - search_type: {settings.retriever_search_type}, k: {settings.retriever_k}")
-    
-    template = """Sos un asistente que responde sobre un dataset de ventas de Retail 360.
-
-Usa EXCLUSIVAMENTE la información del siguiente CONTEXTO para responder la pregunta.
-Si la respuesta no está en el contexto, respondé explícitamente "No tengo suficiente información en los datos para responder esa pregunta."
-NO inventes números, clientes, productos ni datos que no estén en el contexto.
-
-CONTEXTO:
-{context}
-
-PREGUNTA: {question}
-
-RESPUESTA:"""
-
-    prompt = ChatPromptTemplate.from_template(template)
-    logger.info("Prompt template configured")
+    logger.info(f"Retriever created successfully - search_type: {settings.retriever_search_type}, k: {k}")
     
     logger.info("Assembling RAG chain components...")
-    chain = (
-        prompt
-        | llm
-        | StrOutputParser()
-    )
+    chain = build_llm_chain(llm)
     logger.info("RAG chain built successfully")
     
     return chain, retriever
@@ -71,57 +260,129 @@ async def query_rag(
     question: str,
     chain,
     retriever: Optional[Any] = None,
-    history: List[Dict[str, str]] = None
+    history: List[Dict[str, str]] = None,
+    reranker: Optional[Any] = None,
+    summary: Optional[str] = None,
+    llm: Optional[Any] = None,
+    on_token: Optional[Callable[[str], None]] = None,
+    model_router: Optional[Any] = None,
+    cancel: Optional[threading.Event] = None,
+    max_tokens: Optional[int] = None,
+    documents: Optional[List[Any]] = None
 ) -> Dict[str, Any]:
     """
     Ejecuta una consulta sobre el sistema RAG de forma no bloqueante:
     - Offload de operaciones de recuperación y LLM al threadpool.
+    - Re-rank opcional con cross-encoder; si excede el timeout se usan los
+      primeros candidatos del bi-encoder.
+    - Historial acotado: ventana de mensajes recientes + resumen de los viejos,
+      y reescritura de la pregunta de seguimiento para la recuperación.
+    - Con `model_router`, el modelo se elige por pregunta con fallback al más chico.
+    - `cancel` corta la generación en Ollama (cliente desconectado o deadline vencido).
+    - Con `documents` (recuperados en lote, ver /chat/batch) se saltea la recuperación.
     """
     import time
 
-    try:
-        logger.info(f"Starting query_rag for question: {question[:100]}...")
-
-        logger.info("Step 1: Retrieving relevant documents...")
-        retrieval_start = time.time()
-        docs: List[Any] = []
-        if retriever is not None:
-            docs = await asyncio.to_thread(retriever.get_relevant_documents, question)
-        retrieval_time = time.time() - retrieval_start
-        logger.info(f"Step 1 completed: Retrieved {len(docs)} documents in {retrieval_time:.2f}s")
-
-        logger.info("Formatting documents for context...")
-        context_str = format_docs(docs) if docs else ""
-        logger.info("Context string formatted")
-
-        logger.info("Step 2: Invoking LLM chain...")
-        chain_start = time.time()
-        answer = await asyncio.to_thread(
-            chain.invoke,
-            {"context": context_str, "question": question}
-        )
-        chain_time = time.time() - chain_start
-        logger.info(f"Step 2 completed: LLM chain invoked in {chain_time:.2f}s")
-
-        logger.info("Extracting sources from retrieved documents...")
-        sources = []
-        for i, doc in enumerate(docs):
-            source = {
-                'id': str(doc.metadata.get('id', f'doc_{i}')),
-                'type': doc.metadata.get('tipo', 'unknown'),
-                'metadata': doc.metadata,
-                'content': doc.page_content[:200] 
-            }
-            sources.append(source)
-        logger.info(f"Extracted {len(sources)} sources")
-        if sources:
-            logger.info(f"Sample source: {sources[0]}")
+    settings = get_settings()
 
-        return {
-            'answer': answer.strip(),
-            'sources': sources,
-        }
+    with start_span("query_rag", history_messages=len(history or [])):
+        try:
+            logger.info(f"Starting query_rag for question: {question[:100]}...")
 
-    except Exception as e:
-        logger.error(f"Error en query_rag: {e}")
-        raise
+            window = select_window(
+                history or [],
+                settings.history_window_messages,
+                settings.history_max_tokens
+            )
+            if summary:
+                summary = truncate_to_tokens(summary, settings.summary_max_tokens)
+            history_str = format_history(summary, window)
+
+            search_question = question
+            if history_str and llm is not None and settings.condense_question_enabled:
+                logger.info("Step 0: Condensing follow-up question...")
+                with start_span("condense_question"):
+                    search_question = await asyncio.to_thread(condense_question, llm, question, history_str)
+
+            logger.info("Step 1: Retrieving relevant documents...")
+            retrieval_start = time.time()
+            docs: List[Any] = list(documents) if documents is not None else []
+            if retriever is not None and documents is None:
+                # Preguntas comparativas: una sub-consulta por alternativa, recuperadas en paralelo
+                queries = [search_question]
+                if settings.multi_query_enabled:
+                    queries = split_question(search_question, settings.multi_query_max)
+                with start_span("retrieve", subqueries=len(queries)):
+                    if len(queries) > 1:
+                        logger.info(f"Sub-consultas: {queries}")
+                        docs = await asyncio.to_thread(retrieve_multi, retriever, queries)
+                    else:
+                        docs = await asyncio.to_thread(retrieve_documents, retriever, search_question)
+            retrieval_time = time.time() - retrieval_start
+            logger.info(f"Step 1 completed: Retrieved {len(docs)} documents in {retrieval_time:.2f}s")
+
+            if reranker is not None and docs:
+                logger.info("Step 1b: Re-ranking candidates...")
+                try:
+                    with start_span("rerank", candidates=len(docs)):
+                        docs = await asyncio.wait_for(
+                            asyncio.to_thread(rerank_documents, search_question, docs, reranker, settings.rerank_top_n),
+                            timeout=settings.rerank_timeout
+                        )
+                except asyncio.TimeoutError:
+                    logger.warning(f"Re-rank excedió {settings.rerank_timeout}s, usando orden del retriever")
+                    docs = docs[:settings.rerank_top_n]
+                except Exception as e:
+                    logger.warning(f"Error en re-rank: {e}. Usando orden del retriever")
+                    docs = docs[:settings.rerank_top_n]
+
+            logger.info("Formatting documents for context...")
+            with start_span("context_build", documents=len(docs)) as span:
+                budget = context_budget(question, history_str or "(sin historial)")
+                fitted = fit_context(docs, budget)
+                if len(fitted) < len(docs):
+                    logger.info(f"Contexto acotado a {len(fitted)} de {len(docs)} documentos ({budget} tokens)")
+                    span.set_attribute("dropped", len(docs) - len(fitted))
+                # Las fuentes reportadas son las que efectivamente llegaron al prompt
+                docs = fitted
+                context_str = format_docs(docs) if docs else ""
+                span.set_attribute("chars", len(context_str))
+                span.set_attribute("budget_tokens", budget)
+            logger.info("Context string formatted")
+
+            logger.info("Step 2: Invoking LLM chain...")
+            chain_start = time.time()
+            inputs = {"context": context_str, "question": question, "history": history_str or "(sin historial)"}
+            model = settings.ollama_model
+            if model_router is not None:
+                answer, model = await model_router.generate(inputs, question, on_token, cancel, max_tokens)
+            else:
+                answer = await asyncio.to_thread(generate_answer, chain, inputs, model, on_token, cancel, max_tokens)
+            chain_time = time.time() - chain_start
+            logger.info(f"Step 2 completed: LLM chain invoked in {chain_time:.2f}s")
+
+            logger.info("Extracting sources from retrieved documents...")
+            sources = []
+            for i, doc in enumerate(docs):
+                source = {
+                    'id': str(doc.metadata.get('id', f'doc_{i}')),
+                    'doc_id': doc.metadata.get('doc_id'),
+                    'type': doc.metadata.get('tipo', 'unknown'),
+                    'metadata': doc.metadata,
+                    'content': doc.page_content[:200] 
+                }
+                sources.append(source)
+            logger.info(f"Extracted {len(sources)} sources")
+            if sources:
+                logger.info(f"Sample source: {sources[0]}")
+
+            return {
+                'answer': answer.strip(),
+                'sources': sources,
+                'standalone_question': search_question,
+                'model': model,
+            }
+
+        except Exception as e:
+            logger.error(f"Error en query_rag: {e}")
+            raise
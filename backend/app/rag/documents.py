@@ -1,14 +1,136 @@
 import pandas as pd
 from langchain.schema import Document
-from typing import List, Dict
+from typing import List, Dict, Optional
 from langchain.text_splitter import RecursiveCharacterTextSplitter
+import math
 
 import logging
 
 logger = logging.getLogger(__name__)
 
+# Clave de metadata por la que se agrupan las filas de ventas al empaquetarlas
+GROUP_KEYS = {
+    "cliente": "id_cliente",
+    "producto": "id_producto",
+    "dia": "fecha",
+}
 
-def dataframes_to_documents(dataframes: List[pd.DataFrame]):
-    text_splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=200)
-    chunks = text_splitter.split_documents(dataframes)
+
+def parse_row(doc: Document) -> Dict[str, str]:
+    """Convierte un documento de fila ("[VENTA]\\nCampo: valor\\n...") en un dict ordenado."""
+    fields = {}
+    for line in doc.page_content.splitlines()[1:]:
+        key, sep, value = line.partition(": ")
+        if sep:
+            fields[key] = value
+    return fields
+
+
+def _is_number(value) -> bool:
+    return isinstance(value, (int, float)) and not (isinstance(value, float) and math.isnan(value))
+
+
+def _render(group_by: str, parsed: List[Dict[str, str]]) -> str:
+    """
+    Texto denso de un chunk: los campos con el mismo valor en todas las filas van una sola vez
+    en el encabezado y cada fila queda en una línea con el resto de sus campos.
+    """
+    keys = list(parsed[0].keys())
+    shared = [k for k in keys if all(p.get(k) == parsed[0][k] for p in parsed)]
+    lines = [f"[VENTAS por {group_by}]"]
+    if shared:
+        lines.append("; ".join(f"{k}: {parsed[0][k]}" for k in shared))
+    for p in parsed:
+        lines.append("; ".join(f"{k}: {v}" for k, v in p.items() if k not in shared))
+    return "\n".join(lines) + "\n"
+
+
+def _build_chunk(group_by: str, group, rows: List[Document], parsed: List[Dict[str, str]], part: int) -> Document:
+    totals = [row.metadata.get("total") for row in rows if _is_number(row.metadata.get("total"))]
+    fechas = sorted(str(row.metadata["fecha"]) for row in rows if row.metadata.get("fecha"))
+    metadata = {
+        "tipo": "ventas",
+        "id": f"{group_by}:{group}:{part}",
+        "group_by": group_by,
+        "group": group,
+        "ids": [row.metadata.get("id") for row in rows],
+        "rows": len(rows),
+    }
+    for key in ("id_cliente", "id_producto"):
+        values = {row.metadata.get(key) for row in rows}
+        if len(values) == 1:
+            metadata[key] = values.pop()
+    if totals:
+        metadata["total"] = round(sum(totals), 2)
+    if fechas:
+        metadata["fecha_desde"] = fechas[0]
+        metadata["fecha_hasta"] = fechas[-1]
+    return Document(page_content=_render(group_by, parsed), metadata=metadata)
+
+
+def pack_rows(rows: List[Document], group_by: str, chunk_size: int) -> List[Document]:
+    """
+    Empaqueta filas relacionadas (mismo cliente, producto o día) en chunks de hasta
+    chunk_size caracteres, en lugar de un vector por fila.
+    """
+    group_key = GROUP_KEYS[group_by]
+    groups: Dict[object, List[Document]] = {}
+    for row in rows:
+        groups.setdefault(row.metadata.get(group_key), []).append(row)
+
+    chunks = []
+    for group, group_rows in groups.items():
+        current: List[Document] = []
+        current_parsed: List[Dict[str, str]] = []
+        part = 0
+        for row in group_rows:
+            parsed = parse_row(row)
+            if current and len(_render(group_by, current_parsed + [parsed])) > chunk_size:
+                chunks.append(_build_chunk(group_by, group, current, current_parsed, part))
+                current, current_parsed = [], []
+                part += 1
+            current.append(row)
+            current_parsed.append(parsed)
+        if current:
+            chunks.append(_build_chunk(group_by, group, current, current_parsed, part))
+    return chunks
+
+
+def dataframes_to_documents(
+    dataframes: List[Document],
+    group_by: Optional[str] = None,
+    chunk_size: Optional[int] = None
+):
+    """
+    Prepara los documentos de filas para indexar:
+    - Las ventas se empaquetan por grupo en chunks densos con metadata agregada.
+    - Productos y clientes ya son chunks chicos y pasan tal cual; solo se divide
+      lo que supera chunk_size.
+    """
+    from app.config import get_settings
+
+    settings = get_settings()
+    chunk_size = chunk_size or settings.chunk_size
+    group_by = group_by or settings.chunk_group_by
+
+    ventas = [d for d in dataframes if d.metadata.get("tipo") == "venta"]
+    otros = [d for d in dataframes if d.metadata.get("tipo") != "venta"]
+    if not settings.chunk_packing_enabled or group_by not in GROUP_KEYS:
+        otros, ventas = dataframes, []
+
+    text_splitter = RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=200)
+    chunks = []
+    oversized = []
+    for doc in otros:
+        if len(doc.page_content) <= chunk_size:
+            chunks.append(doc)
+        else:
+            oversized.append(doc)
+    if oversized:
+        chunks.extend(text_splitter.split_documents(oversized))
+
+    if ventas:
+        packed = pack_rows(ventas, group_by, chunk_size)
+        logger.info(f"Empaquetadas {len(ventas)} filas de ventas en {len(packed)} chunks (agrupadas por {group_by})")
+        chunks.extend(packed)
     return chunks
@@ -0,0 +1,281 @@
+from langchain_community.vectorstores import FAISS
+from typing import Any, Dict, Iterable, Iterator, List, Tuple
+import asyncio
+import io
+import json
+import logging
+import os
+import pandas as pd
+
+from app.config import get_settings
+from app.excel_loader import ExcelLoader
+from app.rag.documents import GROUP_KEYS, pack_rows
+from app.rag.vectorstore import index_lock, read_index_id, save_vectorstore, unique_source_keys
+
+logger = logging.getLogger(__name__)
+
+TABLES = {
+    "productos": "IdProducto",
+    "clientes": "IdCliente",
+    "ventas": "IdVenta",
+}
+
+# Serializa ingestas, compactaciones y rebuilds sobre el índice en memoria
+ingest_lock = asyncio.Lock()
+
+
+class IngestLog:
+    """
+    Write-ahead log de lotes ingeridos (JSONL, fsync por lote) más un snapshot compactado.
+    Al compactar, las filas del log se funden en `ingest.snapshot.json` (última versión de cada
+    fila por id) y el log se trunca: el log solo guarda los lotes posteriores al último guardado
+    del índice, y el snapshot todo lo ingerido que el Excel no tiene.
+    """
+
+    def __init__(self, directory: str):
+        self.path = os.path.join(directory, "ingest.wal")
+        self.snapshot_path = os.path.join(directory, "ingest.snapshot.json")
+
+    def append(self, batch: Dict[str, Any]) -> int:
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        line = (json.dumps(batch, default=str) + "\n").encode("utf-8")
+        with open(self.path, "ab") as f:
+            f.write(line)
+            f.flush()
+            os.fsync(f.fileno())
+            return f.tell()
+
+    def size(self) -> int:
+        try:
+            return os.path.getsize(self.path)
+        except OSError:
+            return 0
+
+    def truncate(self, offset: int = 0):
+        """Descarta el log a partir de `offset` (un lote que no se pudo aplicar, o todo tras compactar)."""
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, "r+b") as f:
+            f.truncate(offset)
+            f.flush()
+            os.fsync(f.fileno())
+
+    def read(self) -> Iterator[Tuple[int, Dict[str, Any]]]:
+        """Itera (offset_final, lote). Una última línea incompleta (crash a mitad de escritura) se ignora."""
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, "rb") as f:
+            while True:
+                line = f.readline()
+                if not line:
+                    break
+                try:
+                    batch = json.loads(line)
+                except ValueError:
+                    logger.warning(f"Línea inválida en {self.path} (offset {f.tell()}), se ignora")
+                    continue
+                yield f.tell(), batch
+
+    def read_snapshot(self) -> Dict[str, List[Dict[str, Any]]]:
+        try:
+            with open(self.snapshot_path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def write_snapshot(self, batch: Dict[str, List[Dict[str, Any]]]):
+        tmp_path = self.snapshot_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(batch, f, default=str)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.snapshot_path)
+
+
+def merge_batches(batches: Iterable[Dict[str, Any]]) -> Dict[str, List[Dict[str, Any]]]:
+    """Une varios lotes en uno con la última versión de cada fila (por id), en orden de llegada."""
+    merged: Dict[str, Dict[Any, Dict[str, Any]]] = {table: {} for table in TABLES}
+    for batch in batches:
+        for table, id_col in TABLES.items():
+            for row in batch.get(table) or []:
+                merged[table][row.get(id_col)] = row
+    return {table: list(rows.values()) for table, rows in merged.items()}
+
+
+def load_tables(loader: ExcelLoader, log: IngestLog) -> List[Any]:
+    """
+    Carga el Excel y le suma lo ingerido ya compactado en el snapshot.
+    Devuelve los documentos de filas, así un índice construido desde acá ya incluye el snapshot.
+    """
+    documents = loader.load()
+    snapshot = log.read_snapshot()
+    if any(snapshot.get(table) for table in TABLES):
+        loader.upsert_rows(snapshot.get("productos"), snapshot.get("clientes"), snapshot.get("ventas"))
+        documents = loader.build_documents()
+        logger.info(f"Snapshot de ingestas aplicado: {sum(len(snapshot.get(t) or []) for t in TABLES)} filas")
+    return documents
+
+
+def index_version(vectorstore_path: str) -> str:
+    """
+    Versión persistente del contenido del índice: id del índice guardado + tamaño del WAL.
+    Cambia con cada rebuild, compactación o lote ingerido y se mantiene entre reinicios.
+    """
+    return f"{read_index_id(vectorstore_path)}:{IngestLog(vectorstore_path).size()}"
+
+
+def parse_csv_rows(content: bytes) -> List[Dict[str, Any]]:
+    df = pd.read_csv(io.BytesIO(content))
+    df = df.astype(object).where(pd.notna(df), None)
+    return df.to_dict(orient="records")
+
+
+def validate_batch(batch: Dict[str, Any]):
+    """
+    Cada fila debe traer su id; al menos una tabla con filas. Las fechas de ventas se parsean
+    igual que al cargar el Excel (errors="coerce"): una fecha vacía o inválida quedaría NaT y
+    rompería los agregados por año y mes, así que el lote se rechaza antes de llegar al WAL.
+    """
+    total = 0
+    for table, id_col in TABLES.items():
+        rows = batch.get(table) or []
+        for i, row in enumerate(rows):
+            if row.get(id_col) is None:
+                raise ValueError(f"Fila {i} de {table} sin {id_col}")
+        total += len(rows)
+    if total == 0:
+        raise ValueError("El lote no tiene filas")
+
+    ventas = batch.get("ventas") or []
+    date_columns = {
+        col for row in ventas for col in row
+        if 'fecha' in str(col).lower() or 'date' in str(col).lower()
+    }
+    for col in sorted(date_columns):
+        parsed = pd.to_datetime(pd.Series([row.get(col) for row in ventas], dtype=object), errors="coerce")
+        invalid = [i for i, value in enumerate(parsed) if pd.isna(value)]
+        if invalid:
+            shown = ", ".join(str(i) for i in invalid[:10])
+            raise ValueError(f"Fechas inválidas en {col} de ventas (filas {shown}{'…' if len(invalid) > 10 else ''})")
+
+
+def _affected_chunks(docstore: Dict[str, Any], group_by: str, groups: set, venta_ids: set) -> Tuple[List[str], set, set]:
+    """Chunks de ventas a reemplazar: los de grupos afectados o que contienen ventas modificadas."""
+    remove_ids, found_groups, found_ventas = [], set(), set()
+    for doc_id, doc in docstore.items():
+        md = doc.metadata
+        if md.get("tipo") != "ventas" or md.get("group_by") != group_by:
+            continue
+        if md.get("group") in groups or venta_ids.intersection(md.get("ids", [])):
+            remove_ids.append(doc_id)
+            found_groups.add(md.get("group"))
+            found_ventas.update(md.get("ids", []))
+    return remove_ids, found_groups, found_ventas
+
+
+def apply_batch(vectorstore: FAISS, loader: ExcelLoader, batch: Dict[str, Any]) -> Dict[str, int]:
+    """
+    Aplica un lote al índice en memoria: une las filas nuevas con la misma lógica del Excel,
+    regenera solo los documentos afectados, embebe solo esos y hace upsert en FAISS y el docstore.
+    Si algo falla antes de tocar el índice, las tablas del loader vuelven a su estado anterior.
+    """
+    previous = loader.tables()
+    try:
+        return _apply_batch(vectorstore, loader, batch)
+    except Exception:
+        loader.restore_tables(previous)
+        raise
+
+
+def _apply_batch(vectorstore: FAISS, loader: ExcelLoader, batch: Dict[str, Any]) -> Dict[str, int]:
+    settings = get_settings()
+    affected = loader.upsert_rows(batch.get("productos"), batch.get("clientes"), batch.get("ventas"))
+    venta_ids = set(affected["ventas"])
+    docstore = vectorstore.docstore._dict
+
+    new_docs = loader.build_documents(affected["productos"], affected["clientes"], venta_ids)
+    add_docs = [d for d in new_docs if d.metadata.get("tipo") != "venta"]
+    venta_docs = [d for d in new_docs if d.metadata.get("tipo") == "venta"]
+
+    remove_ids = [
+        doc_id for doc_id, doc in docstore.items()
+        if (doc.metadata.get("tipo") == "producto" and doc.metadata.get("id") in affected["productos"])
+        or (doc.metadata.get("tipo") == "cliente" and doc.metadata.get("id") in affected["clientes"])
+        or (doc.metadata.get("tipo") == "venta" and doc.metadata.get("id") in venta_ids)
+    ]
+
+    group_by = settings.chunk_group_by
+    if settings.chunk_packing_enabled and group_by in GROUP_KEYS:
+        # Un chunk empaquetado se regenera entero: se juntan todas las ventas de los
+        # grupos afectados hasta que el conjunto no cambie (una venta puede cambiar de grupo)
+        group_key = GROUP_KEYS[group_by]
+        groups = {d.metadata.get(group_key) for d in venta_docs}
+        chunk_ids: List[str] = []
+        while True:
+            chunk_ids, found_groups, found_ventas = _affected_chunks(docstore, group_by, groups, venta_ids)
+            if found_groups <= groups and found_ventas <= venta_ids:
+                break
+            groups |= found_groups
+            venta_ids |= found_ventas
+            venta_docs = loader.build_documents(set(), set(), venta_ids)
+            groups |= {d.metadata.get(group_key) for d in venta_docs}
+        remove_ids.extend(chunk_ids)
+        add_docs.extend(pack_rows(venta_docs, group_by, settings.chunk_size))
+    else:
+        add_docs.extend(venta_docs)
+
+    # El embedding se calcula fuera del lock para no bloquear búsquedas
+    texts = [d.page_content for d in add_docs]
+    vectors = vectorstore._embed_documents(texts) if texts else []
+    # Los documentos regenerados conservan su clave estable: las fuentes del historial siguen valiendo
+    keys = unique_source_keys(add_docs, set(docstore) - set(remove_ids))
+    for key, doc in zip(keys, add_docs):
+        doc.metadata["doc_id"] = key
+    with index_lock.write():
+        if remove_ids:
+            vectorstore.delete(remove_ids)
+        new_ids = vectorstore.add_embeddings(
+            list(zip(texts, vectors)),
+            metadatas=[d.metadata for d in add_docs],
+            ids=keys
+        ) if texts else []
+
+    logger.info(f"Lote ingerido: {len(remove_ids)} documentos reemplazados, {len(new_ids)} agregados")
+    return {"removed": len(remove_ids), "added": len(new_ids), "embedded": len(texts)}
+
+
+def replay_log(vectorstore: FAISS, loader: ExcelLoader, log: IngestLog) -> int:
+    """
+    Reaplica al arrancar o tras un rebuild los lotes del WAL posteriores a la última compactación,
+    fundidos en un solo lote: un solo join y una sola pasada por el docstore.
+    Reaplicar un lote que el índice ya tiene es inocuo (upsert por clave estable).
+    Devuelve cuántos lotes había en el WAL.
+    """
+    batches = [batch for _, batch in log.read()]
+    if not batches:
+        return 0
+    try:
+        apply_batch(vectorstore, loader, merge_batches(batches))
+        logger.info(f"WAL: {len(batches)} lotes reaplicados al índice")
+    except Exception as e:
+        logger.error(f"Error reaplicando el WAL ({len(batches)} lotes): {e}")
+    return len(batches)
+
+
+def compact(vectorstore: FAISS, log: IngestLog, vectorstore_path: str):
+    """
+    Guarda el índice con los lotes aplicados, funde el WAL en el snapshot y trunca el WAL.
+    Si se corta entre pasos, al arrancar se reaplica un WAL que el índice o el snapshot ya
+    incluyen, sin efecto.
+    """
+    previous_id = read_index_id(vectorstore_path)
+    save_vectorstore(vectorstore, vectorstore_path)
+    index_id = read_index_id(vectorstore_path)
+    if index_id is None or index_id == previous_id:
+        # save_vectorstore no lanza: si no escribió un índice nuevo, el WAL se conserva
+        logger.error("No se pudo compactar el WAL: el índice no se guardó")
+        return
+    batches = [log.read_snapshot()] + [batch for _, batch in log.read()]
+    log.write_snapshot(merge_batches(batches))
+    log.truncate()
+    logger.info(f"WAL compactado: {len(batches) - 1} lotes fundidos en el snapshot")
@@ -0,0 +1,118 @@
+from typing import Any, Dict, List, Optional
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+CONDENSE_TEMPLATE = """Dada la siguiente conversación y una pregunta de seguimiento, reescribí la pregunta de seguimiento para que se entienda sola, sin la conversación.
+Respondé SOLO con la pregunta reescrita, sin explicaciones.
+
+CONVERSACIÓN:
+{history}
+
+PREGUNTA DE SEGUIMIENTO: {question}
+
+PREGUNTA REESCRITA:"""
+
+SUMMARY_TEMPLATE = """Actualizá el resumen de una conversación entre un usuario y un asistente de ventas de Retail 360.
+Conservá los datos concretos mencionados (clientes, productos, ciudades, fechas, cifras) y omití saludos.
+El resumen debe tener como máximo {max_words} palabras.
+
+RESUMEN ACTUAL:
+{summary}
+
+NUEVOS MENSAJES:
+{messages}
+
+RESUMEN ACTUALIZADO:"""
+
+ROLE_LABELS = {"user": "Usuario", "assistant": "Asistente"}
+
+
+def estimate_tokens(text: str) -> int:
+    """Aproximación barata de tokens (~4 caracteres por token)."""
+    return len(text) // 4 + 1
+
+
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    max_chars = max_tokens * 4
+    if len(text) <= max_chars:
+        return text
+    return text[-max_chars:]
+
+
+def select_window(
+    messages: List[Dict[str, Any]],
+    max_messages: int,
+    max_tokens: int
+) -> List[Dict[str, Any]]:
+    """
+    Devuelve los mensajes más recientes que entran en la ventana,
+    limitada tanto por cantidad de mensajes como por presupuesto de tokens.
+    Si el mensaje más reciente solo ya excede el presupuesto, entra recortado.
+    """
+    window: List[Dict[str, Any]] = []
+    used = 0
+    for message in reversed(messages[-max_messages:] if max_messages > 0 and max_tokens > 0 else []):
+        content = message.get("content") or ""
+        cost = estimate_tokens(content)
+        if used + cost > max_tokens:
+            if window:
+                break
+            content = truncate_to_tokens(content, max_tokens - 1)
+            message = {**message, "content": content}
+            cost = estimate_tokens(content)
+        window.append(message)
+        used += cost
+    window.reverse()
+    return window
+
+
+def format_messages(messages: List[Dict[str, Any]]) -> str:
+    return "\n".join(
+        f"{ROLE_LABELS.get(m.get('role'), m.get('role'))}: {m.get('content', '')}"
+        for m in messages
+    )
+
+
+def format_history(summary: Optional[str], messages: List[Dict[str, Any]]) -> str:
+    """Arma el bloque de historial: resumen de turnos viejos + ventana reciente."""
+    parts = []
+    if summary:
+        parts.append(f"Resumen de la conversación previa: {summary}")
+    if messages:
+        parts.append(format_messages(messages))
+    return "\n".join(parts)
+
+
+def condense_question(llm: Any, question: str, history: str) -> str:
+    """Reescribe una pregunta de seguimiento como pregunta independiente para el retriever."""
+    if not history:
+        return question
+    try:
+        prompt = CONDENSE_TEMPLATE.format(history=history, question=question)
+        standalone = llm.invoke(prompt).strip()
+        # Si el modelo devuelve algo vacío o desproporcionado usamos la pregunta original
+        if not standalone or len(standalone) > 4 * len(question) + 200:
+            return question
+        logger.info(f"Condensed question: {standalone[:100]}")
+        return standalone
+    except Exception as e:
+        logger.warning(f"No se pudo reescribir la pregunta: {e}")
+        return question
+
+
+def summarize_messages(
+    llm: Any,
+    summary: Optional[str],
+    messages: List[Dict[str, Any]],
+    max_tokens: int
+) -> str:
+    """Incorpora mensajes que salen de la ventana al resumen acumulado."""
+    prompt = SUMMARY_TEMPLATE.format(
+        max_words=max(20, int(max_tokens * 0.75)),
+        summary=summary or "(vacío)",
+        messages=format_messages(messages),
+    )
+    new_summary = llm.invoke(prompt).strip()
+    return truncate_to_tokens(new_summary, max_tokens)
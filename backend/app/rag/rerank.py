@@ -0,0 +1,61 @@
+from langchain.schema import Document
+from typing import Any, List
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def get_cross_encoder(model_name: str, max_length: int = 256) -> Any:
+    """
+    Carga un cross-encoder pequeño para re-rankear candidatos en CPU.
+
+    Args:
+        model_name: Nombre del modelo de HuggingFace
+        max_length: Longitud máxima (tokens) del par pregunta/documento
+
+    Returns:
+        CrossEncoder: Modelo listo para inferencia
+    """
+    import time
+    from sentence_transformers import CrossEncoder
+
+    try:
+        logger.info(f"Loading cross-encoder model: {model_name}")
+        start_time = time.time()
+
+        cross_encoder = CrossEncoder(model_name, max_length=max_length, device="cpu")
+
+        load_time = time.time() - start_time
+        logger.info(f"Cross-encoder loaded successfully in {load_time:.2f}s: {model_name}")
+        return cross_encoder
+    except Exception as e:
+        logger.error(f"Error al cargar cross-encoder: {e}")
+        raise
+
+
+def rerank_documents(
+    question: str,
+    docs: List[Document],
+    cross_encoder: Any,
+    top_n: int,
+) -> List[Document]:
+    """
+    Puntúa todos los candidatos en una sola pasada batcheada y devuelve los top_n.
+    """
+    import time
+
+    if not docs:
+        return []
+
+    start_time = time.time()
+    pairs = [(question, doc.page_content) for doc in docs]
+    scores = cross_encoder.predict(
+        pairs,
+        batch_size=len(pairs),
+        show_progress_bar=False,
+    )
+    ranked = sorted(zip(docs, scores), key=lambda pair: float(pair[1]), reverse=True)
+
+    rerank_time = time.time() - start_time
+    logger.info(f"Re-ranked {len(docs)} candidates in {rerank_time * 1000:.0f}ms, keeping {top_n}")
+    return [doc for doc, _ in ranked[:top_n]]
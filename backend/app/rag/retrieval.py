@@ -0,0 +1,247 @@
+from concurrent.futures import ThreadPoolExecutor
+from langchain.schema import Document
+from typing import Any, List
+import contextvars
+import logging
+import math
+import re
+import unicodedata
+
+from app.tracing import start_span
+from app.rag.vectorstore import index_lock
+
+logger = logging.getLogger(__name__)
+
+# Separadores de alternativas en preguntas comparativas ("Montevideo vs Salto")
+ALTERNATIVE_SEPARATORS = {"vs", "vs.", "versus"}
+# "contra" solo separa con palabras de comparación: "ventas pagadas contra reembolso" no compara nada
+COMPARATIVE_SEPARATORS = {"contra"}
+# Palabras que delimitan una alternativa: "ventas en Montevideo vs Salto en 2023"
+BOUNDARY_WORDS = {
+    "en", "de", "del", "la", "las", "los", "el", "para", "por", "durante",
+    "con", "a", "al", "entre", "y", "o", "que", "cual", "cuanto", "cuantas", "cuantos",
+}
+EDGE_PUNCTUATION = "¿?¡!.,;:"
+# "entre A y B" solo es comparación si la pregunta lo dice ("compará", "cuál vendió más", ...)
+COMPARISON_RE = re.compile(
+    r"\b(compar\w*|diferencia\w*|mejor\w*|peor\w*|mayor\w*|menor\w*|mas|menos|cual\w*|quien\w*)\b"
+)
+MONTHS = {
+    "enero", "febrero", "marzo", "abril", "mayo", "junio", "julio", "agosto",
+    "septiembre", "setiembre", "octubre", "noviembre", "diciembre",
+}
+
+# FAISS libera el GIL durante la búsqueda: las sub-consultas corren realmente en paralelo
+_search_pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix="retrieval")
+
+
+def _plain(text: str) -> str:
+    return "".join(c for c in unicodedata.normalize("NFKD", text.lower()) if not unicodedata.combining(c))
+
+
+def _is_boundary(token: str, proper_noun: bool = False) -> bool:
+    """
+    Límite de una alternativa. Si las alternativas son nombres propios ("Juan Pérez vs María")
+    también corta en la primera palabra en minúscula.
+    """
+    word = token.strip(EDGE_PUNCTUATION)
+    return not word or _plain(word) in BOUNDARY_WORDS or (proper_noun and not word[0].isupper())
+
+
+def _is_range_end(tokens: List[str]) -> bool:
+    """Extremo de un rango ("entre enero y marzo", "entre 100 y 500"): número, fecha o mes."""
+    return any(
+        any(c.isdigit() for c in token) or _plain(token.strip(EDGE_PUNCTUATION)) in MONTHS
+        for token in tokens
+    )
+
+
+def split_question(question: str, max_queries: int = 4) -> List[str]:
+    """
+    Separa una pregunta comparativa en sub-consultas, una por alternativa, por reglas:
+    "ventas de Notebooks en Montevideo vs Salto en 2023" ->
+    ["ventas de Notebooks en Montevideo en 2023", "ventas de Notebooks en Salto en 2023"].
+    Soporta "A vs/versus B [vs C]", "A frente a B", "A contra B" y "entre A y B"; las dos últimas
+    solo con palabras de comparación ("pagadas contra reembolso" no compara nada), y "entre" además
+    sin números, fechas ni meses en los extremos, porque "ventas entre enero y marzo" es un rango.
+    Si no hay alternativas devuelve [question].
+    """
+    text = re.sub(r"\bfrente a\b", "vs", question, flags=re.IGNORECASE)
+    tokens = text.split()
+    lowered = [t.strip(EDGE_PUNCTUATION).lower() for t in tokens]
+
+    accepted = ALTERNATIVE_SEPARATORS | (COMPARATIVE_SEPARATORS if COMPARISON_RE.search(_plain(question)) else set())
+    separators = [i for i, t in enumerate(lowered) if t in accepted or tokens[i].lower() in accepted]
+    if separators:
+        first, last = separators[0], separators[-1]
+        proper_noun = first + 1 < len(tokens) and tokens[first + 1].strip(EDGE_PUNCTUATION)[:1].isupper()
+        start = first
+        while start > 0 and not _is_boundary(tokens[start - 1], proper_noun):
+            start -= 1
+        end = last + 1
+        while end < len(tokens) and not _is_boundary(tokens[end], proper_noun):
+            end += 1
+        bounds = [start] + [i for i in separators] + [end]
+        alternatives = [
+            " ".join(tokens[bounds[j] + (1 if j else 0):bounds[j + 1]])
+            for j in range(len(bounds) - 1)
+        ]
+    elif (
+        "entre" in lowered and "y" in lowered[lowered.index("entre"):]
+        and COMPARISON_RE.search(_plain(question))
+    ):
+        # "entre A y B": A va de "entre" a "y", B hasta la siguiente palabra límite
+        start = lowered.index("entre")
+        middle = lowered.index("y", start)
+        end = middle + 1
+        while end < len(tokens) and not _is_boundary(tokens[end]):
+            end += 1
+        if _is_range_end(tokens[start + 1:middle]) or _is_range_end(tokens[middle + 1:end]):
+            return [question]
+        alternatives = [" ".join(tokens[start + 1:middle]), " ".join(tokens[middle + 1:end])]
+    else:
+        return [question]
+
+    alternatives = [a.strip(EDGE_PUNCTUATION + " ") for a in alternatives]
+    if len(alternatives) < 2 or not all(alternatives):
+        return [question]
+    prefix = " ".join(tokens[:start])
+    suffix = " ".join(tokens[end:])
+    queries = [" ".join(part for part in (prefix, alt, suffix) if part) for alt in alternatives]
+    return queries[:max_queries]
+
+
+def retrieve_documents(retriever: Any, question: str) -> List[Document]:
+    """
+    Recupera documentos separando embedding y búsqueda FAISS para poder medir cada paso.
+    Para search types distintos de 'similarity' delega en el retriever de LangChain.
+    """
+    vectorstore = getattr(retriever, "vectorstore", None)
+    search_type = getattr(retriever, "search_type", "similarity")
+    if vectorstore is None or search_type != "similarity":
+        with start_span("retriever.search", search_type=search_type), index_lock.read():
+            return retriever.get_relevant_documents(question)
+
+    search_kwargs = dict(retriever.search_kwargs)
+    k = search_kwargs.pop("k", 4)
+    with start_span("embed", chars=len(question)):
+        vector = vectorstore._embed_query(question)
+    with start_span("faiss.search", k=k) as span, index_lock.read():
+        docs = vectorstore.similarity_search_by_vector(vector, k=k, **search_kwargs)
+        span.set_attribute("results", len(docs))
+    return docs
+
+
+def _search_by_vector(vectorstore: Any, vector: List[float], k: int, search_kwargs: dict) -> List[Document]:
+    with start_span("faiss.search", k=k) as span, index_lock.read():
+        docs = vectorstore.similarity_search_by_vector(vector, k=k, **search_kwargs)
+        span.set_attribute("results", len(docs))
+    return docs
+
+
+def _search_with_retriever(retriever: Any, query: str) -> List[Document]:
+    with start_span("retriever.search", search_type=getattr(retriever, "search_type", None)), index_lock.read():
+        return retriever.get_relevant_documents(query)
+
+
+def merge_results(results: List[List[Document]], k: int) -> List[Document]:
+    """
+    Une los resultados de varias sub-consultas sin duplicados: primero hasta ceil(k/n) por
+    sub-consulta, intercalados por ranking, y luego se completa hasta k con los sobrantes.
+    """
+    quota = math.ceil(k / len(results))
+    seen = set()
+    merged: List[Document] = []
+    leftovers: List[Document] = []
+    taken = [0] * len(results)
+    for rank in range(max((len(r) for r in results), default=0)):
+        for i, docs in enumerate(results):
+            if rank >= len(docs):
+                continue
+            doc = docs[rank]
+            key = doc.metadata.get("doc_id") or doc.page_content
+            if key in seen:
+                continue
+            if taken[i] < quota:
+                seen.add(key)
+                taken[i] += 1
+                merged.append(doc)
+            else:
+                leftovers.append(doc)
+    for doc in leftovers:
+        if len(merged) >= k:
+            break
+        key = doc.metadata.get("doc_id") or doc.page_content
+        if key not in seen:
+            seen.add(key)
+            merged.append(doc)
+    return merged[:k]
+
+
+def retrieve_multi(retriever: Any, queries: List[str]) -> List[Document]:
+    """
+    Recupera para varias sub-consultas: un solo embedding en lote para todas y las
+    búsquedas FAISS en paralelo en un pool de threads; luego merge con cupos por sub-consulta.
+    """
+    vectorstore = getattr(retriever, "vectorstore", None)
+    search_type = getattr(retriever, "search_type", "similarity")
+    search_kwargs = dict(retriever.search_kwargs)
+    k = search_kwargs.pop("k", 4)
+
+    # copy_context: los spans de cada thread cuelgan del span actual
+    if vectorstore is None or search_type != "similarity":
+        futures = [
+            _search_pool.submit(contextvars.copy_context().run, _search_with_retriever, retriever, q)
+            for q in queries
+        ]
+    else:
+        # Modelo de embeddings simétrico: embed_documents de las consultas equivale a embed_query
+        with start_span("embed", chars=sum(len(q) for q in queries), batch=len(queries)):
+            vectors = vectorstore._embed_documents(queries)
+        futures = [
+            _search_pool.submit(contextvars.copy_context().run, _search_by_vector, vectorstore, v, k, search_kwargs)
+            for v in vectors
+        ]
+    results = [f.result() for f in futures]
+    docs = merge_results(results, k)
+    logger.info(f"Multi-query: {len(queries)} sub-consultas, {sum(len(r) for r in results)} candidatos, {len(docs)} tras merge")
+    return docs
+
+
+def retrieve_batch(retriever: Any, questions: List[str]) -> List[List[Document]]:
+    """
+    Recupera para muchas preguntas independientes a la vez: un embedding en lote y una sola
+    búsqueda FAISS sobre la matriz de consultas. Con filtros o search types distintos de
+    'similarity' se cae a una búsqueda por pregunta.
+    """
+    import numpy as np
+    from langchain_community.vectorstores.faiss import dependable_faiss_import
+
+    vectorstore = getattr(retriever, "vectorstore", None)
+    search_type = getattr(retriever, "search_type", "similarity")
+    if vectorstore is None or search_type != "similarity":
+        return [_search_with_retriever(retriever, q) for q in questions]
+
+    search_kwargs = dict(retriever.search_kwargs)
+    k = search_kwargs.pop("k", 4)
+    with start_span("embed", chars=sum(len(q) for q in questions), batch=len(questions)):
+        vectors = vectorstore._embed_documents(questions)
+    if search_kwargs:
+        return [_search_by_vector(vectorstore, v, k, search_kwargs) for v in vectors]
+
+    matrix = np.array(vectors, dtype=np.float32)
+    if getattr(vectorstore, "_normalize_L2", False):
+        dependable_faiss_import().normalize_L2(matrix)
+    with start_span("faiss.search", k=k, batch=len(questions)), index_lock.read():
+        _, indices = vectorstore.index.search(matrix, k)
+        results = []
+        for row in indices:
+            docs = []
+            for i in row:
+                if i == -1:
+                    continue
+                doc = vectorstore.docstore.search(vectorstore.index_to_docstore_id[i])
+                if isinstance(doc, Document):
+                    docs.append(doc)
+            results.append(docs)
+    return results
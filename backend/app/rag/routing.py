@@ -0,0 +1,271 @@
+from typing import Any, Callable, Dict, List, Optional, Tuple
+import asyncio
+import logging
+import re
+import threading
+import time
+
+from app.config import get_settings
+from app.metrics import metrics
+from app.tracing import start_span
+from app.rag.chain import build_llm_chain, generate_answer, get_ollama_llm
+from app.rag.singleflight import normalize_question
+
+logger = logging.getLogger(__name__)
+
+# Preguntas analíticas (comparaciones, tendencias, rankings): se aplica sobre texto normalizado sin tildes
+ANALYTIC_RE = re.compile(
+    r"\b(compar\w*|tendencia\w*|evolucion\w*|por que|analiz\w*|promedio\w*|ranking|top|"
+    r"mayor\w*|menor\w*|variacion\w*|crecimiento|porcentaje\w*|proporcion\w*|"
+    r"correlacion\w*|explic\w*|vs|versus|entre)\b"
+)
+
+
+def complexity_score(question: str, context_chars: int, large_context_chars: float) -> int:
+    """
+    Heurística de complejidad: +1 si la pregunta es analítica, +1 si es larga o enumera
+    varias entidades, +1 si el contexto recuperado es grande.
+    """
+    text = normalize_question(question)
+    score = 0
+    if ANALYTIC_RE.search(text):
+        score += 1
+    if len(text.split()) > 25 or text.count(",") + text.count(" y ") >= 3:
+        score += 1
+    if context_chars > large_context_chars:
+        score += 1
+    return score
+
+
+class _LinkedCancel(threading.Event):
+    """Cancelación de un intento: se activa sola o cuando se cancela el request que la contiene."""
+
+    def __init__(self, parent: Optional[threading.Event]):
+        super().__init__()
+        self._parent = parent
+
+    def is_set(self) -> bool:
+        return super().is_set() or (self._parent is not None and self._parent.is_set())
+
+
+class _Attempt:
+    """Una generación en curso con un modelo; retiene sus tokens hasta ser elegida."""
+
+    def __init__(self, model: str, on_token: Optional[Callable[[str], None]], cancel: Optional[threading.Event]):
+        self.model = model
+        self.cancel = _LinkedCancel(cancel)
+        self.first_token = asyncio.Event()
+        self.task: Optional[asyncio.Task] = None
+        self._loop = asyncio.get_running_loop()
+        self._on_token = on_token
+        self._buffer: List[str] = []
+        self._forward = False
+        self._started = False
+        self._lock = threading.Lock()
+
+    def push(self, token: str):
+        """Callback de tokens; se invoca desde el thread del LLM."""
+        if not self._started:
+            self._started = True
+            self._loop.call_soon_threadsafe(self.first_token.set)
+        if self._on_token is None:
+            return
+        with self._lock:
+            if self._forward:
+                self._on_token(token)
+            else:
+                self._buffer.append(token)
+
+    def promote(self):
+        """Elige este intento: vuelca los tokens retenidos y reenvía los siguientes."""
+        if self._on_token is None:
+            return
+        with self._lock:
+            for token in self._buffer:
+                self._on_token(token)
+            self._buffer = []
+            self._forward = True
+
+    @property
+    def failed(self) -> bool:
+        return self.task.done() and not self.first_token.is_set() and (
+            self.task.cancelled() or self.task.exception() is not None
+        )
+
+
+def _consume_result(task: asyncio.Task):
+    # Evita "exception was never retrieved" en los intentos descartados
+    if not task.cancelled():
+        task.exception()
+
+
+class ModelRouter:
+    """
+    Elige el modelo de Ollama por pregunta entre OLLAMA_MODELS (de menor a mayor) y
+    protege el SLO de time to first token: si el modelo elegido no emite el primer token
+    a tiempo (o falla) se usa el más chico, cancelando o compitiendo (hedging) con el primero.
+    """
+
+    def __init__(self):
+        self.base_url = ""
+        self.models: List[str] = []
+        self._chains: Dict[str, Any] = {}
+        self._context_avg: Optional[float] = None
+
+    def configure(self, base_url: str, default_model: str, models: str):
+        self.base_url = base_url
+        self.models = [m.strip() for m in models.split(",") if m.strip()] or [default_model]
+        self._chains = {}
+        logger.info(f"Modelos para routing (de menor a mayor): {self.models}")
+
+    @property
+    def enabled(self) -> bool:
+        return len(self.models) > 1
+
+    @property
+    def smallest(self) -> str:
+        return self.models[0]
+
+    def chain_for(self, model: str):
+        if model not in self._chains:
+            self._chains[model] = build_llm_chain(get_ollama_llm(self.base_url, model))
+        return self._chains[model]
+
+    def large_context_chars(self, context_chars: int) -> float:
+        """
+        Umbral de contexto grande. Con ROUTE_LARGE_CONTEXT_CHARS=0 es relativo al promedio móvil
+        del contexto recuperado: con k alto casi todo contexto supera un umbral fijo, y el término
+        tiene que distinguir preguntas entre sí.
+        """
+        settings = get_settings()
+        if settings.route_large_context_chars > 0:
+            return settings.route_large_context_chars
+        average = self._context_avg
+        self._context_avg = context_chars if average is None else 0.9 * average + 0.1 * context_chars
+        if average is None:
+            return float("inf")
+        return average * settings.route_large_context_factor
+
+    def route(self, question: str, context_chars: int) -> str:
+        score = complexity_score(question, context_chars, self.large_context_chars(context_chars))
+        return self.models[min(score, len(self.models) - 1)]
+
+    def _launch(
+        self,
+        model: str,
+        inputs: Dict[str, Any],
+        on_token,
+        cancel: Optional[threading.Event],
+        max_tokens: Optional[int]
+    ) -> _Attempt:
+        attempt = _Attempt(model, on_token, cancel)
+        attempt.task = asyncio.create_task(asyncio.to_thread(
+            generate_answer, self.chain_for(model), inputs, model, attempt.push, attempt.cancel, max_tokens
+        ))
+        attempt.task.add_done_callback(_consume_result)
+        return attempt
+
+    async def _first_ready(self, attempts: List[_Attempt], timeout: Optional[float]) -> Optional[_Attempt]:
+        """Primer intento que emite un token o termina (bien o con error); None si vence el timeout."""
+        waiters = {asyncio.create_task(a.first_token.wait()): a for a in attempts}
+        waiters.update({a.task: a for a in attempts})
+        done, _ = await asyncio.wait(waiters.keys(), timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+        for waiter in waiters:
+            if waiter not in done and waiters[waiter].task is not waiter:
+                waiter.cancel()
+        if not done:
+            return None
+        ready = [waiters[w] for w in done]
+        return next((a for a in ready if not a.failed), ready[0])
+
+    async def generate(
+        self,
+        inputs: Dict[str, Any],
+        question: str,
+        on_token: Optional[Callable[[str], None]] = None,
+        cancel: Optional[threading.Event] = None,
+        max_tokens: Optional[int] = None
+    ) -> Tuple[str, str]:
+        """
+        Devuelve (respuesta, modelo que la generó). `cancel` corta todos los intentos;
+        si la task se cancela (aunque ya haya ganador) el finally también los corta:
+        cancelar el await del ganador no detiene su thread.
+        """
+        settings = get_settings()
+        primary = self.route(question, len(inputs.get("context", "")))
+        fallback = self.smallest if primary != self.smallest else None
+        hedge = settings.llm_hedge_enabled
+        metrics.incr(f"llm_routed.{primary}")
+
+        with start_span("llm.route", model=primary, hedge=hedge) as span:
+            active = [self._launch(primary, inputs, on_token, cancel, max_tokens)]
+            fallback_launched = False
+            winner: Optional[_Attempt] = None
+            finished = False
+            start_time = time.time()
+            try:
+                while winner is None:
+                    timeout = None
+                    if fallback and not fallback_launched:
+                        delay = settings.llm_hedge_delay if hedge else settings.llm_ttft_slo
+                        timeout = max(0.0, delay - (time.time() - start_time))
+                    ready = await self._first_ready(active, timeout)
+
+                    if ready is None:
+                        # Sin primer token a tiempo: con hedging compiten ambos, si no se corta el primario
+                        reason = "hedge" if hedge else "timeout"
+                        if not hedge:
+                            active[0].cancel.set()
+                            active.pop(0)
+                    elif ready.failed:
+                        active.remove(ready)
+                        if not fallback or fallback_launched:
+                            if active:
+                                continue
+                            # Ningún intento quedó en pie: se propaga el error del último
+                            raise ready.task.exception()
+                        reason = "error"
+                    else:
+                        winner = ready
+                        continue
+
+                    logger.warning(f"Modelo {primary} sin primer token ({reason}), usando {fallback}")
+                    metrics.incr(f"llm_fallback.{reason}")
+                    span.set_attribute("fallback", reason)
+                    active.append(self._launch(fallback, inputs, on_token, cancel, max_tokens))
+                    fallback_launched = True
+
+                for attempt in active:
+                    if attempt is not winner:
+                        attempt.cancel.set()
+                winner.promote()
+                if fallback_launched:
+                    metrics.incr(f"llm_race_wins.{winner.model}")
+                span.set_attribute("winner", winner.model)
+                answer = await winner.task
+                finished = True
+                return answer, winner.model
+            finally:
+                if not finished:
+                    for attempt in active:
+                        attempt.cancel.set()
+
+    def snapshot(self) -> Dict[str, Any]:
+        """Uso y latencia por modelo, a partir de las métricas del proceso."""
+        data = metrics.snapshot()
+        counters, timings = data["counters"], data["timings"]
+        return {
+            model: {
+                "routed": counters.get(f"llm_routed.{model}", 0),
+                "requests": counters.get(f"llm_requests.{model}", 0),
+                "cancelled": counters.get(f"llm_cancelled.{model}", 0),
+                "race_wins": counters.get(f"llm_race_wins.{model}", 0),
+                "chunks": counters.get(f"llm_chunks.{model}", 0),
+                "ttft": timings.get(f"llm_ttft.{model}"),
+                "generation": timings.get(f"llm_generation.{model}"),
+            }
+            for model in self.models
+        }
+
+
+model_router = ModelRouter()
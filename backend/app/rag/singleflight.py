@@ -0,0 +1,151 @@
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional
+import asyncio
+import logging
+import re
+import threading
+import unicodedata
+
+from app.metrics import metrics
+from app.tracing import current_span
+
+logger = logging.getLogger(__name__)
+
+TokenCallback = Callable[[str], None]
+FlightFactory = Callable[[TokenCallback, threading.Event], Awaitable[Any]]
+
+
+def normalize_question(question: str) -> str:
+    """Normaliza una pregunta para detectar duplicados: minúsculas, sin tildes ni puntuación final."""
+    text = unicodedata.normalize("NFKD", question.lower())
+    text = "".join(c for c in text if not unicodedata.combining(c))
+    text = re.sub(r"\s+", " ", text).strip()
+    return text.strip("¿?¡!. ")
+
+
+def flight_key(question: str, generation: int, max_tokens: Optional[int] = None) -> str:
+    return f"{generation}:{max_tokens or ''}:{normalize_question(question)}"
+
+
+class Flight:
+    """
+    Una computación en curso compartida por varios requests.
+    Guarda los tokens generados para que cada suscriptor pueda reproducir el stream desde el inicio.
+    Cuando el último suscriptor se va (desconexión o deadline) la computación se aborta.
+    """
+
+    def __init__(self, key: Optional[str]):
+        self.key = key
+        self.tokens: List[str] = []
+        self.done = False
+        self.subscribers = 1
+        self.task: Optional[asyncio.Task] = None
+        self.cancel = threading.Event()
+        self._loop = asyncio.get_running_loop()
+        self._event = asyncio.Event()
+
+    def push_threadsafe(self, token: str):
+        """Callback de tokens; se invoca desde el thread que ejecuta el LLM."""
+        self._loop.call_soon_threadsafe(self._push, token)
+
+    def _push(self, token: str):
+        self.tokens.append(token)
+        self._notify()
+
+    def _notify(self):
+        event, self._event = self._event, asyncio.Event()
+        event.set()
+
+    def finish(self):
+        self.done = True
+        self._notify()
+
+    def leave(self):
+        """Un suscriptor deja de esperar; si era el último y no terminó, se aborta."""
+        self.subscribers -= 1
+        if self.subscribers <= 0 and not self.done:
+            self.abort()
+
+    def abort(self):
+        # El evento corta el stream del LLM en su thread; cancelar la task corta lo que esté en await
+        if self.cancel.is_set():
+            return
+        self.cancel.set()
+        if self.task is not None:
+            self.task.cancel()
+        metrics.incr("singleflight_aborted")
+        logger.info("Computación abortada: no quedan suscriptores")
+
+    async def stream(self) -> AsyncIterator[str]:
+        index = 0
+        while True:
+            event = self._event
+            while index < len(self.tokens):
+                yield self.tokens[index]
+                index += 1
+            if self.done:
+                return
+            await event.wait()
+
+    async def result(self) -> Any:
+        # shield: si un suscriptor se cancela, la computación sigue para los demás
+        return await asyncio.shield(self.task)
+
+
+class SingleFlight:
+    """Coalesce requests idénticos concurrentes sobre una única computación."""
+
+    def __init__(self):
+        self._flights: Dict[str, Flight] = {}
+        self._active = 0
+
+    def join(
+        self,
+        key: str,
+        factory: FlightFactory,
+        coalesce: bool = True
+    ) -> Flight:
+        """
+        Devuelve el Flight en curso para `key` o inicia uno nuevo con factory(on_token, cancel).
+        Con coalesce=False se crea un Flight privado (p. ej. preguntas con historial).
+        """
+        if coalesce:
+            flight = self._flights.get(key)
+            if flight is not None and not flight.done and not flight.cancel.is_set():
+                flight.subscribers += 1
+                metrics.incr("singleflight_coalesced")
+                span = current_span()
+                if span is not None:
+                    span.set_attribute("singleflight.coalesced", True)
+                logger.info(f"Request coalescida con una computación en curso ({flight.subscribers} suscriptores)")
+                return flight
+
+        flight = Flight(key if coalesce else None)
+        if coalesce:
+            self._flights[key] = flight
+            metrics.incr("singleflight_leaders")
+        self._active += 1
+        flight.task = asyncio.create_task(self._run(flight, factory))
+        return flight
+
+    async def _run(self, flight: Flight, factory: FlightFactory) -> Any:
+        try:
+            return await factory(flight.push_threadsafe, flight.cancel)
+        finally:
+            # Los tokens pendientes en call_soon_threadsafe se procesan antes que este finish
+            await asyncio.sleep(0)
+            flight.finish()
+            self._active -= 1
+            if flight.key is not None and self._flights.get(flight.key) is flight:
+                del self._flights[flight.key]
+
+    @property
+    def in_flight(self) -> int:
+        return len(self._flights)
+
+    @property
+    def active(self) -> int:
+        """Computaciones en curso, incluidas las privadas (con historial)."""
+        return self._active
+
+
+coalescer = SingleFlight()
@@ -1,46 +1,106 @@
 from langchain_community.vectorstores import FAISS
 from langchain.schema import Document
 from langchain.embeddings.base import Embeddings
-from typing import List, Optional
+from typing import Dict, List, Optional
 import os
 import pickle
 import logging
+import threading
+import uuid
+from contextlib import contextmanager
 
 logger = logging.getLogger(__name__)
 
+INDEX_ID_FILE = "index.id"
 
-def load_vectorstore_or_build(
-    documents: List[Document],
-    embeddings: Embeddings,
-    vectorstore_path: str
-) -> FAISS:
+
+class ReadWriteLock:
+    """Lock lectores/escritor: búsquedas concurrentes, mutaciones del índice en exclusiva."""
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._readers = 0
+        self._writer = False
+
+    @contextmanager
+    def read(self):
+        with self._cond:
+            while self._writer:
+                self._cond.wait()
+            self._readers += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._readers -= 1
+                if self._readers == 0:
+                    self._cond.notify_all()
+
+    @contextmanager
+    def write(self):
+        with self._cond:
+            while self._writer or self._readers:
+                self._cond.wait()
+            self._writer = True
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._writer = False
+                self._cond.notify_all()
+
+
+# Protege el índice FAISS en memoria frente a la ingesta incremental
+index_lock = ReadWriteLock()
+
+
+def read_index_id(vectorstore_path: str) -> Optional[str]:
+    """Identificador del índice guardado en disco; cambia en cada save_vectorstore."""
+    try:
+        with open(os.path.join(vectorstore_path, INDEX_ID_FILE)) as f:
+            return f.read().strip() or None
+    except OSError:
+        return None
+
+
+def load_vectorstore(embeddings: Embeddings, vectorstore_path: str) -> Optional[FAISS]:
     """
-    Carga el vector store desde disco o lo construye si no existe.
+    Carga el vector store desde disco. Devuelve None si no existe o no se pudo leer.
+    No necesita los documentos: al arrancar corre en paralelo con el parseo del Excel.
     """
     import time
-    
+
     index_file = os.path.join(vectorstore_path, "index.faiss")
     pkl_file = os.path.join(vectorstore_path, "index.pkl")
-    
-    # Intentar cargar desde disco
-    if os.path.exists(index_file) and os.path.exists(pkl_file):
-        try:
-            logger.info(f"Attempting to load vector store from {vectorstore_path}")
-            start_time = time.time()
-            
-            vectorstore = FAISS.load_local(
-                vectorstore_path,
-                embeddings,
-                allow_dangerous_deserialization=True
-            )
-            
-            load_time = time.time() - start_time
-            logger.info(f"Vector store loaded successfully from disk in {load_time:.2f}s")
-            return vectorstore
-        except Exception as e:
-            logger.warning(f"Error al cargar vector store: {e}. Reconstruyendo...")
-    
-    # Construir nuevo vector store
+    if not (os.path.exists(index_file) and os.path.exists(pkl_file)):
+        return None
+    try:
+        logger.info(f"Attempting to load vector store from {vectorstore_path}")
+        start_time = time.time()
+
+        vectorstore = FAISS.load_local(
+            vectorstore_path,
+            embeddings,
+            allow_dangerous_deserialization=True
+        )
+
+        load_time = time.time() - start_time
+        logger.info(f"Vector store loaded successfully from disk in {load_time:.2f}s")
+        assign_doc_ids(vectorstore)
+        return vectorstore
+    except Exception as e:
+        logger.warning(f"Error al cargar vector store: {e}. Reconstruyendo...")
+        return None
+
+
+def build_vectorstore(
+    documents: List[Document],
+    embeddings: Embeddings,
+    vectorstore_path: str
+) -> FAISS:
+    """Construye el vector store desde los documentos y lo guarda en disco."""
+    import time
+
     logger.info(f"Building new vector store with {len(documents)} documents")
     start_time = time.time()
     
@@ -48,6 +108,7 @@ def load_vectorstore_or_build(
     
     build_time = time.time() - start_time
     logger.info(f"Vector store built successfully in {build_time:.2f}s")
+    assign_doc_ids(vectorstore)
     
     # Guardar en disco
     save_vectorstore(vectorstore, vectorstore_path)
@@ -55,6 +116,69 @@ def load_vectorstore_or_build(
     return vectorstore
 
 
+def load_vectorstore_or_build(
+    documents: List[Document],
+    embeddings: Embeddings,
+    vectorstore_path: str
+) -> FAISS:
+    """
+    Carga el vector store desde disco o lo construye si no existe.
+    """
+    vectorstore = load_vectorstore(embeddings, vectorstore_path)
+    if vectorstore is None:
+        vectorstore = build_vectorstore(documents, embeddings, vectorstore_path)
+    return vectorstore
+
+
+def source_key(metadata: Dict) -> str:
+    """
+    Clave estable de un documento: tipo + id de la fila o del chunk empaquetado.
+    No cambia entre rebuilds ni ingestas, así las fuentes guardadas en el historial siguen resolviendo.
+    """
+    return f"{metadata.get('tipo', 'doc')}:{metadata.get('id')}"
+
+
+def unique_source_keys(documents: List[Document], taken: Optional[set] = None) -> List[str]:
+    """Claves estables para `documents`; las repetidas (filas partidas, ids duplicados) llevan sufijo #n."""
+    taken = set(taken or ())
+    keys = []
+    for doc in documents:
+        base = source_key(doc.metadata)
+        key, n = base, 1
+        while key in taken:
+            key = f"{base}#{n}"
+            n += 1
+        taken.add(key)
+        keys.append(key)
+    return keys
+
+
+def assign_doc_ids(vectorstore: FAISS):
+    """
+    Re-indexa el docstore con claves estables (ver source_key) y las copia a metadata['doc_id'],
+    para poder referenciar fuentes de forma compacta y resolverlas después.
+    """
+    docstore = vectorstore.docstore._dict
+    keys = unique_source_keys(list(docstore.values()))
+    mapping = dict(zip(docstore.keys(), keys))
+    for key, doc in zip(keys, docstore.values()):
+        doc.metadata["doc_id"] = key
+    vectorstore.docstore._dict = dict(zip(keys, docstore.values()))
+    vectorstore.index_to_docstore_id = {
+        i: mapping[old_id] for i, old_id in vectorstore.index_to_docstore_id.items()
+    }
+
+
+def get_documents_by_ids(vectorstore: FAISS, doc_ids: List[str]) -> Dict[str, Document]:
+    """Resuelve varios ids del docstore en una sola pasada; ignora los inexistentes."""
+    found = {}
+    for doc_id in doc_ids:
+        doc = vectorstore.docstore.search(doc_id)
+        if isinstance(doc, Document):
+            found[doc_id] = doc
+    return found
+
+
 def save_vectorstore(vectorstore: FAISS, vectorstore_path: str):
     """Guarda el vector store en disco."""
     import time
@@ -64,7 +188,10 @@ def save_vectorstore(vectorstore: FAISS, vectorstore_path: str):
         start_time = time.time()
         
         os.makedirs(vectorstore_path, exist_ok=True)
-        vectorstore.save_local(vectorstore_path)
+        with index_lock.read():
+            vectorstore.save_local(vectorstore_path)
+        with open(os.path.join(vectorstore_path, INDEX_ID_FILE), "w") as f:
+            f.write(uuid.uuid4().hex)
         
         save_time = time.time() - start_time
         logger.info(f"Vector store saved successfully in {save_time:.2f}s")
@@ -89,6 +216,7 @@ def rebuild_vectorstore(
     
     build_time = time.time() - start_time
     logger.info(f"Vector store rebuilt in {build_time:.2f}s")
+    assign_doc_ids(vectorstore)
     
     save_vectorstore(vectorstore, vectorstore_path)
     return vectorstore
@@ -0,0 +1,253 @@
+from datetime import datetime, timedelta
+from fastapi import HTTPException, Request
+from pymongo import ReturnDocument
+from typing import Any, Dict, List, Optional
+import ipaddress
+import logging
+import math
+import time
+import uuid
+
+from app.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class RateLimitDecision:
+    """Resultado de consumir un token: alcanza para armar los headers RateLimit-*."""
+
+    def __init__(self, allowed: bool, limit: int, remaining: float, rate: float):
+        self.allowed = allowed
+        self.limit = limit
+        self.remaining = max(0, int(remaining))
+        # Segundos hasta recuperar el bucket completo / hasta tener un token disponible
+        self.reset = math.ceil((limit - remaining) / rate) if rate > 0 else 0
+        self.retry_after = 0 if allowed else max(1, math.ceil((1 - remaining) / rate)) if rate > 0 else 60
+        self.window = math.ceil(limit / rate) if rate > 0 else 0
+
+    def headers(self) -> Dict[str, str]:
+        headers = {
+            "RateLimit-Limit": str(self.limit),
+            "RateLimit-Remaining": str(self.remaining),
+            "RateLimit-Reset": str(self.reset),
+            "RateLimit-Policy": f"{self.limit};w={self.window}",
+        }
+        if not self.allowed:
+            headers["Retry-After"] = str(self.retry_after)
+        return headers
+
+
+class RateLimiter:
+    """
+    Token bucket por clave (user_id o IP) más un tope de generaciones concurrentes.
+
+    En modo "memory" el estado vive en el proceso. En modo "mongo" cada bucket es un documento
+    de `rate_limits` actualizado con un pipeline atómico (refill + consumo en un solo
+    find_one_and_update), así el límite se respeta entre workers. Si Mongo no está disponible
+    se usa el estado en memoria.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.backend = "memory"
+        self.rate = 1.0
+        self.burst = 1
+        self.max_concurrent = 0
+        self.lease_ttl = 300.0
+        self.trusted_proxies: List[Any] = []
+        self.db = None
+        self._buckets: Dict[str, Dict[str, float]] = {}
+        self._active: Dict[str, int] = {}
+
+    def configure(
+        self,
+        enabled: bool,
+        backend: str,
+        per_minute: float,
+        burst: int,
+        max_concurrent: int,
+        lease_ttl: float,
+        trusted_proxies: str = ""
+    ):
+        self.enabled = enabled
+        self.backend = backend
+        self.rate = per_minute / 60.0
+        self.burst = burst
+        self.max_concurrent = max_concurrent
+        self.lease_ttl = lease_ttl
+        self.trusted_proxies = []
+        for entry in trusted_proxies.split(","):
+            if entry.strip():
+                try:
+                    self.trusted_proxies.append(ipaddress.ip_network(entry.strip(), strict=False))
+                except ValueError:
+                    logger.warning(f"TRUSTED_PROXIES: red inválida '{entry.strip()}', se ignora")
+
+    def is_trusted_proxy(self, host: str) -> bool:
+        try:
+            address = ipaddress.ip_address(host)
+        except ValueError:
+            return False
+        return any(address in network for network in self.trusted_proxies)
+
+    async def attach(self, db):
+        """Habilita el modo mongo una vez conectada la base."""
+        if self.backend != "mongo":
+            return
+        await db.rate_limits.create_index("expires_at", expireAfterSeconds=0)
+        self.db = db
+
+    def _consume_memory(self, key: str) -> RateLimitDecision:
+        now = time.time()
+        if len(self._buckets) > 10000:
+            idle = self.burst / self.rate if self.rate > 0 else 0
+            self._buckets = {k: b for k, b in self._buckets.items() if now - b["updated"] < idle}
+        bucket = self._buckets.setdefault(key, {"tokens": float(self.burst), "updated": now})
+        tokens = min(self.burst, bucket["tokens"] + (now - bucket["updated"]) * self.rate)
+        allowed = tokens >= 1
+        if allowed:
+            tokens -= 1
+        bucket["tokens"], bucket["updated"] = tokens, now
+        return RateLimitDecision(allowed, self.burst, tokens, self.rate)
+
+    async def _consume_mongo(self, key: str) -> RateLimitDecision:
+        now = time.time()
+        refilled = {"$min": [
+            self.burst,
+            {"$add": [
+                {"$ifNull": ["$tokens", self.burst]},
+                {"$multiply": [{"$subtract": [now, {"$ifNull": ["$updated", now]}]}, self.rate]},
+            ]},
+        ]}
+        idle = self.burst / self.rate if self.rate > 0 else 0
+        doc = await self.db.rate_limits.find_one_and_update(
+            {"_id": f"bucket:{key}"},
+            [
+                {"$set": {"tokens": refilled, "updated": now}},
+                # En un mismo $set todas las expresiones ven el valor ya recargado
+                {"$set": {
+                    "allowed": {"$gte": ["$tokens", 1]},
+                    "tokens": {"$cond": [{"$gte": ["$tokens", 1]}, {"$subtract": ["$tokens", 1]}, "$tokens"]},
+                    "expires_at": datetime.utcnow() + timedelta(seconds=idle + 60),
+                }},
+            ],
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
+        )
+        return RateLimitDecision(doc["allowed"], self.burst, doc["tokens"], self.rate)
+
+    async def consume(self, key: str) -> RateLimitDecision:
+        if self.db is not None:
+            try:
+                return await self._consume_mongo(key)
+            except Exception as e:
+                logger.warning(f"Rate limit en Mongo no disponible, usando memoria: {e}")
+        return self._consume_memory(key)
+
+    async def acquire_slot(self, key: str) -> Optional[str]:
+        """Reserva una generación concurrente; devuelve el id de la reserva o None si no hay lugar."""
+        if self.max_concurrent <= 0:
+            return ""
+        if self.db is not None:
+            try:
+                return await self._acquire_slot_mongo(key)
+            except Exception as e:
+                logger.warning(f"Concurrencia en Mongo no disponible, usando memoria: {e}")
+        if self._active.get(key, 0) >= self.max_concurrent:
+            return None
+        self._active[key] = self._active.get(key, 0) + 1
+        return "memory"
+
+    async def _acquire_slot_mongo(self, key: str) -> Optional[str]:
+        # Las reservas vencen a los lease_ttl segundos por si un worker muere sin liberarlas
+        now = time.time()
+        lease = uuid.uuid4().hex
+        doc = await self.db.rate_limits.find_one_and_update(
+            {"_id": f"slots:{key}"},
+            [
+                {"$set": {"leases": {"$filter": {
+                    "input": {"$ifNull": ["$leases", []]},
+                    "cond": {"$gt": ["$$this.expires", now]},
+                }}}},
+                {"$set": {
+                    "leases": {"$cond": [
+                        {"$lt": [{"$size": "$leases"}, self.max_concurrent]},
+                        {"$concatArrays": ["$leases", [{"id": lease, "expires": now + self.lease_ttl}]]},
+                        "$leases",
+                    ]},
+                    "expires_at": datetime.utcnow() + timedelta(seconds=self.lease_ttl),
+                }},
+            ],
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
+        )
+        if any(entry["id"] == lease for entry in doc["leases"]):
+            return lease
+        return None
+
+    async def release_slot(self, key: str, lease: Optional[str]):
+        if not lease:
+            return
+        if lease == "memory":
+            remaining = self._active.get(key, 0) - 1
+            if remaining > 0:
+                self._active[key] = remaining
+            else:
+                self._active.pop(key, None)
+            return
+        try:
+            await self.db.rate_limits.update_one({"_id": f"slots:{key}"}, {"$pull": {"leases": {"id": lease}}})
+        except Exception as e:
+            logger.warning(f"No se pudo liberar la reserva de concurrencia de {key}: {e}")
+
+    async def enter(self, key: str) -> Optional[Dict[str, Any]]:
+        """
+        Consume un token y reserva un lugar de generación para `key`.
+        Lanza 429 con Retry-After si se excede alguno de los dos límites.
+        Devuelve el estado a pasar a leave() (None si el limitador está apagado).
+        """
+        if not self.enabled:
+            return None
+        decision = await self.consume(key)
+        if not decision.allowed:
+            metrics.incr("rate_limited.rate")
+            logger.info(f"Rate limit excedido para {key}")
+            raise HTTPException(status_code=429, detail="Demasiadas consultas, intentá más tarde", headers=decision.headers())
+        lease = await self.acquire_slot(key)
+        if lease is None:
+            metrics.incr("rate_limited.concurrency")
+            headers = decision.headers()
+            headers["Retry-After"] = "1"
+            raise HTTPException(status_code=429, detail="Demasiadas consultas en curso", headers=headers)
+        return {"key": key, "lease": lease, "decision": decision}
+
+    async def leave(self, state: Optional[Dict[str, Any]]):
+        if state is not None:
+            await self.release_slot(state["key"], state["lease"])
+
+
+def client_key(request: Request) -> str:
+    """
+    IP del cliente. Si la conexión viene de un proxy confiable (TRUSTED_PROXIES, p. ej. el nginx
+    del frontend) se toma de X-Forwarded-For: la primera dirección desde la derecha que no sea
+    otro proxy confiable, porque las de la izquierda las puede inventar el cliente.
+    """
+    host = request.client.host if request.client else "unknown"
+    if rate_limiter.is_trusted_proxy(host):
+        forwarded = [h.strip() for h in request.headers.get("x-forwarded-for", "").split(",") if h.strip()]
+        for candidate in reversed(forwarded):
+            host = candidate
+            if not rate_limiter.is_trusted_proxy(candidate):
+                break
+    return f"ip:{host}"
+
+
+def apply_headers(response, state: Optional[Dict[str, Any]]):
+    if state is not None:
+        response.headers.update(state["decision"].headers())
+
+
+rate_limiter = RateLimiter()
+# Jobs de /chat/batch: cuota propia por cliente (jobs por hora y jobs simultáneos), separada
+# de las consultas interactivas; las preguntas de cada job las acota la capacidad de Ollama
+batch_limiter = RateLimiter()
@@ -0,0 +1,77 @@
+from typing import Any, Awaitable, Callable, Dict, Optional
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class StageStatus:
+    """Estado y duración de una etapa de arranque."""
+
+    def __init__(self, name: str, required: bool = True):
+        self.name = name
+        self.required = required
+        self.status = "pending"
+        self.started_at: Optional[float] = None
+        self.duration: Optional[float] = None
+        self.error: Optional[str] = None
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "status": self.status,
+            "required": self.required,
+            "duration": round(self.duration, 3) if self.duration is not None else None,
+            "error": self.error,
+        }
+
+
+class StartupTracker:
+    """
+    Registra las etapas del arranque progresivo.
+    Cada etapa se ejecuta con run(); si falla, queda marcada como 'failed'
+    y las etapas que dependen de ella como 'skipped'.
+    """
+
+    def __init__(self):
+        self.stages: Dict[str, StageStatus] = {}
+
+    def register(self, name: str, required: bool = True) -> StageStatus:
+        stage = StageStatus(name, required)
+        self.stages[name] = stage
+        return stage
+
+    async def run(self, name: str, func: Callable[[], Awaitable[Any]]) -> Any:
+        stage = self.stages.get(name) or self.register(name)
+        stage.status = "running"
+        stage.started_at = time.time()
+        logger.info(f"Startup stage '{name}' iniciada")
+        try:
+            result = await func()
+        except Exception as e:
+            stage.duration = time.time() - stage.started_at
+            stage.status = "failed"
+            stage.error = str(e)
+            logger.error(f"Startup stage '{name}' falló en {stage.duration:.2f}s: {e}")
+            raise
+        stage.duration = time.time() - stage.started_at
+        stage.status = "ok"
+        logger.info(f"Startup stage '{name}' completada en {stage.duration:.2f}s")
+        return result
+
+    def skip(self, name: str, reason: str):
+        stage = self.stages.get(name) or self.register(name)
+        stage.status = "skipped"
+        stage.error = reason
+        logger.warning(f"Startup stage '{name}' omitida: {reason}")
+
+    @property
+    def ready(self) -> bool:
+        return bool(self.stages) and all(
+            stage.status == "ok" for stage in self.stages.values() if stage.required
+        )
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {name: stage.to_dict() for name, stage in self.stages.items()}
+
+
+startup_tracker = StartupTracker()
@@ -0,0 +1,263 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Dict, Iterator, List, Optional
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+import asyncio
+import httpx
+import json
+import logging
+import os
+import re
+import secrets
+import threading
+import time
+
+from app.profiler import profiler_controller
+
+logger = logging.getLogger(__name__)
+
+TRACEPARENT_RE = re.compile(r"^00-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})$")
+
+
+class Span:
+    """Span mínimo compatible con el modelo de OpenTelemetry (ids W3C, tiempos en ns)."""
+
+    def __init__(self, name: str, trace_id: str, parent_id: Optional[str] = None, attributes: Optional[dict] = None):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = secrets.token_hex(8)
+        self.parent_id = parent_id
+        self.attributes: Dict[str, Any] = dict(attributes or {})
+        self.start_ns = time.time_ns()
+        self.end_ns: Optional[int] = None
+        self.error: Optional[str] = None
+
+    def set_attribute(self, key: str, value: Any):
+        self.attributes[key] = value
+
+    @property
+    def traceparent(self) -> str:
+        return f"00-{self.trace_id}-{self.span_id}-01"
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "start_ns": self.start_ns,
+            "end_ns": self.end_ns,
+            "duration_ms": round((self.end_ns - self.start_ns) / 1e6, 3) if self.end_ns else None,
+            "attributes": self.attributes,
+            "error": self.error,
+        }
+
+
+_current_span: ContextVar[Optional[Span]] = ContextVar("current_span", default=None)
+
+
+def current_span() -> Optional[Span]:
+    return _current_span.get()
+
+
+def parse_traceparent(header: Optional[str]) -> Optional[tuple]:
+    """Devuelve (trace_id, parent_span_id) de un header W3C traceparent válido."""
+    if not header:
+        return None
+    match = TRACEPARENT_RE.match(header.strip().lower())
+    if not match or match.group(1) == "0" * 32:
+        return None
+    return match.group(1), match.group(2)
+
+
+@contextmanager
+def start_span(name: str, traceparent: Optional[str] = None, **attributes) -> Iterator[Span]:
+    """
+    Abre un span hijo del span actual (o raíz, continuando `traceparent` si viene).
+    asyncio.to_thread copia el contexto, así que los spans abiertos en threads
+    quedan colgados del span que lanzó el thread.
+    """
+    parent = _current_span.get()
+    if parent is not None:
+        span = Span(name, parent.trace_id, parent.span_id, attributes)
+    else:
+        remote = parse_traceparent(traceparent)
+        if remote:
+            span = Span(name, remote[0], remote[1], attributes)
+        else:
+            span = Span(name, secrets.token_hex(16), None, attributes)
+    token = _current_span.set(span)
+    try:
+        yield span
+    except BaseException as e:
+        span.error = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        span.end_ns = time.time_ns()
+        _current_span.reset(token)
+        trace_exporter.record(span)
+
+
+def _otlp_value(value: Any) -> Dict[str, Any]:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+def to_otlp(spans: List[Span], service_name: str) -> Dict[str, Any]:
+    """Serializa spans al formato OTLP/HTTP JSON."""
+    return {
+        "resourceSpans": [{
+            "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": service_name}}]},
+            "scopeSpans": [{
+                "scope": {"name": "app.tracing"},
+                "spans": [
+                    {
+                        "traceId": span.trace_id,
+                        "spanId": span.span_id,
+                        "parentSpanId": span.parent_id or "",
+                        "name": span.name,
+                        "kind": 1,
+                        "startTimeUnixNano": str(span.start_ns),
+                        "endTimeUnixNano": str(span.end_ns),
+                        "attributes": [{"key": k, "value": _otlp_value(v)} for k, v in span.attributes.items()],
+                        "status": {"code": 2, "message": span.error} if span.error else {"code": 1},
+                    }
+                    for span in spans
+                ],
+            }],
+        }]
+    }
+
+
+class TraceExporter:
+    """
+    Acumula spans terminados y los exporta en lotes desde una task de fondo,
+    a un archivo JSONL local o a un collector OTLP/HTTP.
+    """
+
+    def __init__(self):
+        self.mode = "none"
+        self.path = ""
+        self.otlp_endpoint = ""
+        self.max_bytes = 0
+        self.service_name = "retail360-backend"
+        self._buffer: List[Span] = []
+        self._lock = threading.Lock()
+        self._task: Optional[asyncio.Task] = None
+
+    def configure(self, mode: str, path: str, otlp_endpoint: str, max_bytes: int = 0):
+        self.mode = mode
+        self.path = path
+        self.otlp_endpoint = otlp_endpoint
+        self.max_bytes = max_bytes
+
+    def record(self, span: Span):
+        if self.mode == "none":
+            return
+        with self._lock:
+            self._buffer.append(span)
+
+    def _drain(self) -> List[Span]:
+        with self._lock:
+            spans, self._buffer = self._buffer, []
+        return spans
+
+    def _write_jsonl(self, spans: List[Span]):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        # Rotación simple: se conserva un solo archivo anterior (.1)
+        if self.max_bytes > 0 and os.path.exists(self.path) and os.path.getsize(self.path) >= self.max_bytes:
+            os.replace(self.path, self.path + ".1")
+        with open(self.path, "a", encoding="utf-8") as f:
+            for span in spans:
+                f.write(json.dumps(span.to_dict(), default=str) + "\n")
+
+    async def flush(self):
+        spans = self._drain()
+        if not spans:
+            return
+        try:
+            if self.mode == "jsonl":
+                await asyncio.to_thread(self._write_jsonl, spans)
+            elif self.mode == "otlp":
+                async with httpx.AsyncClient(timeout=5.0) as client:
+                    response = await client.post(self.otlp_endpoint, json=to_otlp(spans, self.service_name))
+                    response.raise_for_status()
+        except Exception as e:
+            logger.warning(f"No se pudieron exportar {len(spans)} spans: {e}")
+
+    async def _loop(self, interval: float):
+        while True:
+            await asyncio.sleep(interval)
+            await self.flush()
+
+    def start(self, interval: float):
+        if self.mode != "none" and self._task is None:
+            self._task = asyncio.create_task(self._loop(interval))
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+
+trace_exporter = TraceExporter()
+
+
+class TracingMiddleware:
+    """
+    Abre el span raíz de cada request continuando el header `traceparent` entrante
+    y lo devuelve en la respuesta. Si el profiler está activo y la request es elegida
+    (header X-Profile: 1 o muestreo), se perfila y se devuelve X-Profile-Id.
+
+    Es ASGI puro: el span y el profiler terminan cuando la app envió el último
+    `http.response.body`, no al devolver los headers, así las respuestas en streaming
+    (/chat/stream, /chat/batch) quedan cubiertas enteras.
+    """
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        headers = Headers(scope=scope)
+        path = scope["path"]
+        with start_span(
+            "http.request",
+            traceparent=headers.get("traceparent"),
+            **{"http.method": scope["method"], "http.target": path}
+        ) as span:
+            profiler = None
+            if profiler_controller.should_profile(headers.get("x-profile") == "1"):
+                profiler = profiler_controller.acquire()
+            start_time = time.time()
+
+            async def send_wrapper(message: Message):
+                if message["type"] == "http.response.start":
+                    span.set_attribute("http.status_code", message["status"])
+                    response_headers = MutableHeaders(scope=message)
+                    response_headers["traceparent"] = span.traceparent
+                    if profiler is not None:
+                        response_headers["X-Profile-Id"] = span.trace_id
+                await send(message)
+
+            try:
+                await self.app(scope, receive, send_wrapper)
+            finally:
+                if profiler is not None:
+                    profiler_controller.release(profiler, span.trace_id, path, time.time() - start_time)
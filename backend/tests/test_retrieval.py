@@ -0,0 +1,49 @@
+import pytest
+
+from app.rag.retrieval import split_question
+
+
+@pytest.mark.parametrize("question", [
+    "ventas entre enero y marzo de 2023",
+    "cuántas ventas hubo entre 2022 y 2023?",
+    "productos con precio entre 100 y 500",
+    "¿cuál producto vendió más entre enero y marzo?",
+    "comparar ventas entre el 2023-01-01 y el 2023-06-30",
+    "ventas de clientes entre Montevideo y Salto",
+])
+def test_entre_ranges_are_not_split(question):
+    assert split_question(question) == [question]
+
+
+@pytest.mark.parametrize("question", [
+    "ventas pagadas contra reembolso en 2023",
+    "productos vendidos contra pedido en Montevideo",
+])
+def test_contra_without_comparison_is_not_split(question):
+    assert split_question(question) == [question]
+
+
+@pytest.mark.parametrize("question, expected", [
+    (
+        "ventas de Notebooks en Montevideo vs Salto en 2023",
+        ["ventas de Notebooks en Montevideo en 2023", "ventas de Notebooks en Salto en 2023"],
+    ),
+    (
+        "¿cuál vendió más entre Notebooks y Monitores?",
+        ["¿cuál vendió más Notebooks", "¿cuál vendió más Monitores"],
+    ),
+    (
+        "¿quién compró más entre Juan y María en 2023?",
+        ["¿quién compró más Juan en 2023?", "¿quién compró más María en 2023?"],
+    ),
+    (
+        "compras de Juan Pérez vs María",
+        ["compras de Juan Pérez", "compras de María"],
+    ),
+    (
+        "comparar ventas de Notebooks en Montevideo contra Salto en 2023",
+        ["comparar ventas de Notebooks en Montevideo en 2023", "comparar ventas de Notebooks en Salto en 2023"],
+    ),
+])
+def test_comparisons_are_split(question, expected):
+    assert split_question(question) == expected
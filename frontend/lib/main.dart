@@ -60,7 +60,7 @@ class ChatApp extends StatefulWidget {
 class Message {
   final String role;
   final String content;
-  final List<Source>? sources;
+  List<Source>? sources;
   bool sourcesExpanded;
   Message({
     required this.role,
@@ -72,11 +72,13 @@ class Message {
 
 class Source {
   final String? id;
+  final String? docId;
   final String? type;
   final Map<String, dynamic> metadata;
   final String? content;
   Source({
     this.id,
+    this.docId,
     this.type,
     required this.metadata,
     this.content,
@@ -85,6 +87,7 @@ class Source {
     Map<String, dynamic> json,
   ) => Source(
     id: json['id'],
+    docId: json['doc_id'],
     type: json['type'],
     metadata: json['metadata'] ?? {},
     content: json['content'],
@@ -174,6 +177,7 @@ class _ChatAppState extends State<ChatApp> {
       );
       if (resp.statusCode == 200) {
         final data = jsonDecode(resp.body);
+        // El historial trae referencias compactas: se resuelven al desplegar las fuentes
         final msgs = (data['messages'] as List)
             .map((m) {
               final sources =
@@ -197,6 +201,54 @@ class _ChatAppState extends State<ChatApp> {
     } catch (_) {}
   }
 
+  Future<Map<String, Source>> _resolveSources(
+    List<String> docIds,
+  ) async {
+    final resolved = <String, Source>{};
+    // El backend resuelve hasta 200 ids por llamada
+    for (var i = 0; i < docIds.length; i += 200) {
+      final batch = docIds.sublist(
+        i,
+        i + 200 < docIds.length ? i + 200 : docIds.length,
+      );
+      try {
+        final resp = await http.post(
+          Uri.parse('$apiUrl/api/sources/resolve'),
+          headers: {
+            'Content-Type': 'application/json',
+          },
+          body: jsonEncode({'ids': batch}),
+        );
+        if (resp.statusCode == 200) {
+          for (final s in jsonDecode(resp.body) as List) {
+            final source = Source.fromJson(s);
+            if (source.docId != null) {
+              resolved[source.docId!] = source;
+            }
+          }
+        }
+      } catch (_) {}
+    }
+    return resolved;
+  }
+
+  Future<void> _toggleSources(Message m) async {
+    setState(() => m.sourcesExpanded = !m.sourcesExpanded);
+    final pending = (m.sources ?? [])
+        .where((s) => s.docId != null && s.content == null)
+        .map((s) => s.docId!)
+        .toSet()
+        .toList();
+    if (!m.sourcesExpanded || pending.isEmpty) return;
+    final resolved = await _resolveSources(pending);
+    if (resolved.isEmpty) return;
+    setState(() {
+      m.sources = m.sources!
+          .map((s) => resolved[s.docId] ?? s)
+          .toList();
+    });
+  }
+
   Future<void> _newChat() async {
     try {
       final resp = await http.post(
@@ -657,13 +709,9 @@ class _ChatAppState extends State<ChatApp> {
                                               12,
                                         ),
                                         InkWell(
-                                          onTap: () {
-                                            setState(
-                                              () {
-                                                m.sourcesExpanded = !m.sourcesExpanded;
-                                              },
-                                            );
-                                          },
+                                          onTap: () => _toggleSources(
+                                            m,
+                                          ),
                                           borderRadius:
                                               BorderRadius.circular(
                                                 8,
@@ -778,7 +826,7 @@ class _ChatAppState extends State<ChatApp> {
                                                         width: 6,
                                                       ),
                                                       Text(
-                                                        'ID: ${s.id ?? 'N/A'}',
+                                                        'ID: ${s.id ?? s.docId ?? 'N/A'}',
                                                         style: const TextStyle(
                                                           fontSize: 11,
                                                           color: Color(